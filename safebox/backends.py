@@ -15,17 +15,228 @@ See the License for the specific language governing permissions and
 limitations under the License.
 
 """
-import bz2
+import binascii
+import collections
+import errno
 import fnmatch
+import httplib
 import os
+import Queue
+import re
+import socket
+import struct
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
 
+from safebox import compression, stats, utils
 
-class LocalStorage(object):
+# Permissions of files created by the local backends
+OBJECT_MODE = 0644
+
+
+class ChunkIndex(object):
+    """ Persistent set of object names known to exist in a storage.
+
+    Names are kept in memory and are appended to a log file as "+name" or
+    "-name" lines once they are added or removed. Added names are logged in
+    batches of batch_size lines or by flush(), removed names right away. The
+    log is compacted when loading it if most of its lines are obsolete.
+    Names of content addressed objects are kept as binary digests to save
+    memory.
+
+    Every batch is appended by a single write, thus several processes may
+    log to the same file. """
+    batch_size = 1024
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.names = None
+        self.pending = []
+
+    @staticmethod
+    def key(name):
+        if len(name) == 66 and name[1] == "-":
+            try:
+                return name[0] + binascii.unhexlify(name[2:])
+            except TypeError:
+                pass
+        return name
+
+    def load(self):
+        names = set()
+        lines = 0
+        try:
+            with open(self.filename) as infile:
+                for line in infile:
+                    lines += 1
+                    if line[0] == "+":
+                        names.add(self.key(line[1:-1]))
+                    else:
+                        names.discard(self.key(line[1:-1]))
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.names = names
+        if lines > 1000 and lines > 2 * len(names):
+            self.compact()
+
+    def compact(self):
+        """ Rewrite the log file with a single line per existing name """
+        fd, tmpname = tempfile.mkstemp(
+            dir=os.path.dirname(self.filename),
+            prefix=os.path.basename(self.filename) + ".")
+        with os.fdopen(fd, "w") as outfile:
+            os.fchmod(outfile.fileno(), OBJECT_MODE)
+            for key in self.names:
+                if len(key) == 33:
+                    key = "%s-%s" % (key[0], binascii.hexlify(key[1:]))
+                outfile.write("+%s\n" % key)
+        os.rename(tmpname, self.filename)
+
+    def rebuild(self, names):
+        """ Replace all known names by the given ones and rewrite the log """
+        with self.lock:
+            self.names = set(self.key(name) for name in names)
+            self.pending = []
+            self.compact()
+
+    def _log(self, op, names):
+        self.pending.extend("%s%s\n" % (op, name) for name in names)
+
+    def _flush(self):
+        """ Append pending lines to the log; must be called with lock held """
+        if not self.pending:
+            return
+        dirname = os.path.dirname(self.filename)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        data = "".join(self.pending)
+        fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     OBJECT_MODE)
+        try:
+            written = 0
+            while written < len(data):
+                written += os.write(fd, buffer(data, written))
+        finally:
+            os.close(fd)
+        self.pending = []
+
+    def flush(self):
+        """ Append all pending lines to the log """
+        with self.lock:
+            self._flush()
+
+    def __contains__(self, name):
+        with self.lock:
+            if self.names is None:
+                self.load()
+            return self.key(name) in self.names
+
+    def add(self, name):
+        with self.lock:
+            if self.names is None:
+                self.load()
+            key = self.key(name)
+            if key not in self.names:
+                self.names.add(key)
+                self._log("+", [name])
+                if len(self.pending) >= self.batch_size:
+                    self._flush()
+
+    def discard_many(self, names):
+        with self.lock:
+            if self.names is None:
+                self.load()
+            for name in names:
+                self.names.discard(self.key(name))
+            # A lost removal would let a deleted object appear to exist
+            self._log("-", names)
+            self._flush()
+
+
+BATCH_READ_AHEAD = 64
+
+
+class Storage(object):
+    """ Batch operations common to all storage backends.
+
+    Backends implement put, get, exists and delete for single objects; the
+    batch methods are built upon them. Each batch method accepts a
+    utils.WorkerPool to run the single calls concurrently and to share the
+    threads with other work of the caller. Without a pool, a temporary one
+    with self.concurrency workers is used.
+
+    Backends setting process_safe may be used by several processes at once,
+    see common.backup(). """
+    concurrency = 0
+    process_safe = False
+
+    def _map(self, func, items, pool=None):
+        """ Yields (item, func(item)) for all items in their order """
+        own_pool = pool is None
+        if own_pool:
+            pool = utils.WorkerPool(self.concurrency)
+        try:
+            jobs = ((item, pool.submit(func, item)) for item in items)
+            for item, job in utils.read_ahead(jobs, BATCH_READ_AHEAD):
+                yield item, job.result()
+        finally:
+            if own_pool:
+                pool.close()
+
+    def put_many(self, items, pool=None):
+        """ Write (name, data) pairs, returns the names of new objects """
+        def put(item):
+            return self.put(*item)
+        return [item[0] for item, stored in self._map(put, items, pool)
+                if stored]
+
+    def get_many(self, names, pool=None):
+        """ Read objects, yields (name, data) pairs in the order of names
+
+        Objects are fetched ahead of the consumer, every pair is returned as
+        soon as it and its predecessors have arrived. """
+        return self._map(self.get, names, pool)
+
+    def exists_many(self, names, pool=None):
+        """ Return the set of names of existing objects """
+        return set(name for name, exists in self._map(self.exists, names, pool)
+                   if exists)
+
+    def delete_many(self, names, pool=None):
+        """ Delete a batch of objects """
+        for _ in self._map(self.delete, names, pool):
+            pass
+
+    def size_many(self, names, pool=None):
+        """ Return the stored sizes of objects, yields (name, size) pairs """
+        return self._map(self.size, names, pool)
+
+    def flush(self):
+        """ Persist state the backend keeps in memory """
+        pass
+
+    def close(self):
+        """ Flush and release resources; the backend may still be used
+        afterwards """
+        self.flush()
+
+
+class LocalStorage(Storage):
     """ Storage backend using local files.
 
-    Useful for testing and backing up to external disks. """
-    def __init__(self, path):
+    Useful for testing and backing up to external disks. Objects are
+    compressed using the given codec, see compression.Codec. """
+    process_safe = True
+
+    def __init__(self, path, codec="bz2"):
         self.path = path
+        self.codec = compression.Codec(codec)
+        self.index = ChunkIndex(os.path.join(path, "index"))
 
     def fullname(self, name):
         """ Return the full name of an object
@@ -45,32 +256,616 @@ class LocalStorage(object):
         return (pathname, fullname)
 
     def put(self, name, data):
-        """ Write an object if not yet existing """
+        """ Write an object if not yet existing
+
+        Names of stored chunks and objects are remembered in an index, thus
+        known objects are neither compressed nor looked up on disk again.
+        Safe to be called from multiple threads at once; only one of them
+        will store an object if it is written concurrently. """
+        indexed = name[0] != "b"
+        if indexed and name in self.index:
+            return False
         pathname, filename = self.fullname(name)
-        if not os.path.exists(pathname):
-            os.makedirs(pathname)
+        _makedirs(pathname)
+        stored = False
         if not os.path.exists(filename):
-            with open(filename, "wb") as outfile:
-                outfile.write(bz2.compress(data))
-                return True
-        return False
+            data = self.codec.compress(data)
+            with stats.timer("backend_write"):
+                stored = self._create(filename, data)
+            if stored:
+                stats.add("stored_bytes", len(data))
+        if indexed:
+            self.index.add(name)
+        return stored
+
+    def _create(self, filename, data):
+        """ Create a file with the given data unless it exists
+
+        Data is written to a temporary file in tmp/ first, which is then
+        linked to filename. Objects are thus never found incomplete, and
+        only one of several concurrent writers creates a file. Returns True
+        if the file was created. """
+        tmp_path = os.path.join(self.path, "tmp")
+        _makedirs(tmp_path)
+        fd, tmpname = tempfile.mkstemp(dir=tmp_path)
+        try:
+            with os.fdopen(fd, "wb") as outfile:
+                os.fchmod(outfile.fileno(), OBJECT_MODE)
+                outfile.write(data)
+            os.link(tmpname, filename)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        finally:
+            os.remove(tmpname)
+        return True
 
     def get(self, name):
         """ Read an object """
         pathname, filename = self.fullname(name)
-        with open(filename) as infile:
-            data = infile.read()
-            return bz2.decompress(data)
+        with stats.timer("backend_read"):
+            with open(filename, "rb") as infile:
+                data = infile.read()
+        return compression.decompress(data)
+
+    def exists(self, name):
+        """ Return True if an object exists """
+        if name[0] != "b" and name in self.index:
+            return True
+        pathname, filename = self.fullname(name)
+        return os.path.exists(filename)
 
     def delete(self, name):
         """ Delete an object """
+        self.delete_many([name])
+
+    def put_many(self, items, pool=None):
+        """ Write (name, data) pairs, returns the names of new objects
+
+        Names found in the index are skipped before compressing their data. """
+        items = ((name, data) for name, data in items
+                 if name[0] == "b" or name not in self.index)
+        return super(LocalStorage, self).put_many(items, pool)
+
+    def exists_many(self, names, pool=None):
+        """ Return the set of names of existing objects
+
+        Only names missing in the index are looked up in the filesystem. """
+        found = set()
+        missing = []
+        for name in names:
+            if name[0] != "b" and name in self.index:
+                found.add(name)
+            else:
+                missing.append(name)
+        return found | super(LocalStorage, self).exists_many(missing, pool)
+
+    def delete_many(self, names, pool=None):
+        """ Delete a batch of objects """
+        try:
+            for name in names:
+                pathname, filename = self.fullname(name)
+                os.remove(filename)
+        finally:
+            self.index.discard_many(
+                [name for name in names if name[0] != "b"])
+
+    def size(self, name):
+        """ Return the stored size of an object """
         pathname, filename = self.fullname(name)
-        os.remove(filename)
+        return os.path.getsize(filename)
+
+    def flush(self):
+        """ Log names added to the index """
+        self.index.flush()
+
+    def rebuild_index(self):
+        """ Rebuild the index from the objects found on disk
+
+        The index misses objects written by other means and still lists
+        objects that have been deleted out of band. Returns the number of
+        indexed names. """
+        names = [os.path.basename(filename)
+                 for filename in LocalStorage.list(self)]
+        names = [name for name in names if name[0] != "b"]
+        self.index.rebuild(names)
+        return len(names)
+
+    def list(self, prefix=""):
+        """ List objects, filtering with prefix if given
+
+        Objects are stored in one directory per type, named after the first
+        character of the object names (see fullname()). If the prefix starts
+        with a literal character, only this directory is scanned; for
+        example listing "b-*" does not touch any chunk directories.
+
+        Returns an iterator of full filenames. """
+        if prefix and prefix[0] not in "*?[":
+            types = [prefix[0]]
+        else:
+            types = sorted(name for name in _listdir(self.path)
+                           if len(name) == 1)
+        for objtype in types:
+            top = os.path.join(self.path, objtype)
+            if objtype == "b":
+                dirnames = [top]
+            else:
+                dirnames = (os.path.join(top, first, second)
+                            for first in _listdir(top)
+                            for second in _listdir(os.path.join(top, first)))
+            for dirname in dirnames:
+                for filename in fnmatch.filter(_listdir(dirname),
+                                               prefix or "*"):
+                    yield os.path.join(dirname, filename)
+
+
+# Packs start with PACK_MAGIC; every chunk is preceded by a PACK_RECORD of
+# the length of its name and data, and its name. Packs written by earlier
+# versions only contain the chunk data.
+PACK_MAGIC = "SBP1"
+PACK_RECORD = struct.Struct(">HI")
+
+
+def _fsync_directory(path):
+    """ Persist the names of files created in or removed from a directory """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class PackedStorage(LocalStorage):
+    """ Storage backend appending chunks to large pack files.
+
+    Storing millions of small chunks as single files wastes inodes and makes
+    copying a backup slow. Chunks are therefore appended to pack files in
+    the directory p/, and an append-only index maps each chunk name to its
+    pack, offset and length. Index lines of new chunks are logged once their
+    pack is full and synced, or by flush(). Other objects and chunks stored
+    by LocalStorage are still read and written as single files.
+
+    Deleted chunks are only removed from the index; repack() rewrites packs
+    containing a large share of deleted chunks. Packs are appended by a
+    single process only. Chunks are stored along with their names, thus
+    rebuild() is able to recover a lost index from the packs. """
+    process_safe = False
+
+    def __init__(self, path, codec="bz2", pack_size=64 * 2 ** 20):
+        super(PackedStorage, self).__init__(path, codec)
+        self.pack_size = pack_size
+        self.pack_path = os.path.join(path, "p")
+        self.pack_index = os.path.join(self.pack_path, "index")
+        self.pack_lock = threading.Lock()
+        self.packs = None
+        self.current = None
+        self.pending = []
+
+    def _load(self):
+        """ Load the pack index, compacting it if mostly obsolete """
+        packs = {}
+        lines = 0
+        try:
+            with open(self.pack_index) as infile:
+                for line in infile:
+                    lines += 1
+                    fields = line.split()
+                    if fields[0][0] == "+":
+                        packs[fields[0][1:]] = (
+                            fields[1], int(fields[2]), int(fields[3]))
+                    else:
+                        packs.pop(fields[0][1:], None)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.packs = packs
+        if lines > 1000 and lines > 2 * len(packs):
+            self._write_index()
+
+    def _write_index(self):
+        """ Replace the index by a single line per packed chunk """
+        tmpname = self.pack_index + ".tmp"
+        with open(tmpname, "w") as outfile:
+            for name, location in self.packs.iteritems():
+                outfile.write("+%s %s %d %d\n" % ((name, ) + location))
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.rename(tmpname, self.pack_index)
+        _fsync_directory(self.pack_path)
+
+    def _packs(self):
+        if self.packs is None:
+            with self.pack_lock:
+                if self.packs is None:
+                    self._load()
+        return self.packs
+
+    def _log(self, lines, sync=False):
+        """ Append pending lines and lines to the index; must be called with
+        lock held. If sync is set, they are persisted before returning """
+        lines = self.pending + lines
+        self.pending = []
+        if not lines:
+            return
+        _makedirs(self.pack_path)
+        with open(self.pack_index, "a") as outfile:
+            outfile.write("".join(lines))
+            if sync:
+                outfile.flush()
+                os.fsync(outfile.fileno())
+        if sync:
+            _fsync_directory(self.pack_path)
+
+    def _write_current(self, data):
+        """ Append data to the current pack; after a failed write the pack
+        is not appended to anymore, since its end is unknown """
+        pack, fd, _ = self.current
+        try:
+            written = 0
+            while written < len(data):
+                written += os.write(fd, buffer(data, written))
+        except OSError:
+            self.current = None
+            os.close(fd)
+            raise
+        self.current[2] += len(data)
+
+    def _append(self, name, data):
+        """ Append data to the current pack; must be called with lock held
+
+        Full packs are synced when they are closed, and the pending index
+        lines of their chunks are logged then. """
+        if self.current is None or self.current[2] >= self.pack_size:
+            if self.current:
+                os.fsync(self.current[1])
+                os.close(self.current[1])
+                self._log([])
+            _makedirs(self.pack_path)
+            pack = binascii.hexlify(os.urandom(16))
+            fd = os.open(os.path.join(self.pack_path, pack + ".pack"),
+                         os.O_WRONLY | os.O_CREAT | os.O_EXCL, OBJECT_MODE)
+            self.current = [pack, fd, 0]
+            self._write_current(PACK_MAGIC)
+        pack, fd, offset = self.current
+        record = PACK_RECORD.pack(len(name), len(data)) + name
+        with stats.timer("backend_write"):
+            self._write_current(record + data)
+        stats.add("stored_bytes", len(data))
+        return pack, offset + len(record), len(data)
+
+    def put(self, name, data):
+        """ Append a chunk to a pack file if not yet existing """
+        if not name.startswith("c-"):
+            return super(PackedStorage, self).put(name, data)
+        if name in self._packs() or super(PackedStorage, self).exists(name):
+            return False
+        data = self.codec.compress(data)
+        with self.pack_lock:
+            if name in self.packs:
+                return False
+            location = self._append(name, data)
+            self.pending.append("+%s %s %d %d\n" % ((name, ) + location))
+            self.packs[name] = location
+        return True
+
+    def flush(self):
+        """ Sync the current pack and log the index lines of its chunks """
+        with self.pack_lock:
+            if self.current and self.pending:
+                os.fsync(self.current[1])
+            self._log([])
+        super(PackedStorage, self).flush()
+
+    def _read(self, location):
+        pack, offset, length = location
+        with stats.timer("backend_read"):
+            fd = os.open(os.path.join(self.pack_path, pack + ".pack"),
+                         os.O_RDONLY)
+            try:
+                os.lseek(fd, offset, os.SEEK_SET)
+                data = os.read(fd, length)
+            finally:
+                os.close(fd)
+        if len(data) != length:
+            raise IOError("Short read from pack %s" % pack)
+        return data
+
+    def get(self, name):
+        """ Read an object, using a ranged read for packed chunks """
+        location = self._packs().get(name)
+        if location is None:
+            return super(PackedStorage, self).get(name)
+        return compression.decompress(self._read(location))
+
+    def exists(self, name):
+        return name in self._packs() or \
+            super(PackedStorage, self).exists(name)
+
+    def delete_many(self, names, pool=None):
+        packs = self._packs()
+        packed = [name for name in names if name in packs]
+        if packed:
+            with self.pack_lock:
+                self._log(["-%s\n" % name for name in packed])
+                for name in packed:
+                    packs.pop(name, None)
+        super(PackedStorage, self).delete_many(
+            [name for name in names if name not in packed])
+
+    def size(self, name):
+        location = self._packs().get(name)
+        if location is None:
+            return super(PackedStorage, self).size(name)
+        return location[2]
 
     def list(self, prefix=""):
-        """ List objects, filtering with prefix if given """
-        matches = []
-        for root, dirnames, filenames in os.walk(self.path):
-            for filename in fnmatch.filter(filenames, prefix):
-                matches.append(os.path.join(root, filename))
-        return matches
+        """ List objects including packed chunks """
+        for filename in super(PackedStorage, self).list(prefix):
+            yield filename
+        for name in fnmatch.filter(list(self._packs()), prefix or "*"):
+            yield name
+
+    def repack(self, threshold=0.5):
+        """ Rewrite packs if more than threshold of their data is unused
+
+        Returns the number of bytes freed. """
+        packs = self._packs()
+        with self.pack_lock:
+            used = collections.defaultdict(int)
+            for pack, _, length in packs.itervalues():
+                used[pack] += length
+            current = self.current[0] if self.current else None
+            sizes = {}
+            for filename in _listdir(self.pack_path):
+                if filename.endswith(".pack"):
+                    pack = filename[:-len(".pack")]
+                    sizes[pack] = os.path.getsize(
+                        os.path.join(self.pack_path, filename))
+            obsolete = set(
+                pack for pack, size in sizes.iteritems()
+                if pack != current and size and
+                1 - float(used[pack]) / size > threshold)
+            lines = []
+            for name, location in packs.items():
+                if location[0] in obsolete:
+                    location = self._append(name, self._read(location))
+                    lines.append("+%s %s %d %d\n" % ((name, ) + location))
+                    packs[name] = location
+            # Moved chunks and their index lines must be persisted before
+            # removing the packs they were copied from
+            if self.current:
+                os.fsync(self.current[1])
+            self._log(lines, sync=True)
+            freed = 0
+            for pack in obsolete:
+                os.remove(os.path.join(self.pack_path, pack + ".pack"))
+                freed += sizes[pack] - used[pack]
+        return freed
+
+    def _scan(self, pack):
+        """ Returns (name, location) tuples of all chunks in a pack, or None
+        if the pack was written by an earlier version. A chunk cut off by a
+        crash while appending it is ignored. """
+        chunks = []
+        with open(os.path.join(self.pack_path, pack + ".pack"), "rb") as f:
+            if f.read(len(PACK_MAGIC)) != PACK_MAGIC:
+                return None
+            size = os.fstat(f.fileno()).st_size
+            offset = len(PACK_MAGIC)
+            while offset + PACK_RECORD.size <= size:
+                name_length, length = PACK_RECORD.unpack(
+                    f.read(PACK_RECORD.size))
+                name = f.read(name_length)
+                offset += PACK_RECORD.size + name_length
+                if len(name) < name_length or offset + length > size:
+                    break
+                chunks.append((name, (pack, offset, length)))
+                offset += length
+                f.seek(offset)
+        return chunks
+
+    def rebuild(self):
+        """ Rewrite the index from the chunk names stored in the packs
+
+        Chunks deleted after they were packed are listed again, until gc
+        deletes them once more. Entries of packs written by earlier versions
+        are kept if the pack still exists. Returns the number of packed
+        chunks. """
+        packs = self._packs()
+        with self.pack_lock:
+            rebuilt = {}
+            unnamed = set()
+            for filename in sorted(_listdir(self.pack_path)):
+                if not filename.endswith(".pack"):
+                    continue
+                pack = filename[:-len(".pack")]
+                chunks = self._scan(pack)
+                if chunks is None:
+                    unnamed.add(pack)
+                else:
+                    rebuilt.update(chunks)
+            for name, location in packs.iteritems():
+                if location[0] in unnamed:
+                    rebuilt.setdefault(name, location)
+            self.packs = rebuilt
+            self.pending = []
+            if os.path.exists(self.pack_path):
+                self._write_index()
+        return len(rebuilt)
+
+
+class SwiftStorage(Storage):
+    """ Storage backend using a container in OpenStack Swift.
+
+    url is the storage URL of the container, for example
+    http://127.0.0.1:8080/v1/AUTH_test/backups. Objects are stored as flat
+    names and compressed like in LocalStorage.
+
+    Up to max_connections requests are sent concurrently, using persistent
+    connections that are shared by all threads. Batch operations use as many
+    threads by default. Failing requests are retried
+    with an exponential backoff. """
+    list_limit = 10000
+    process_safe = True
+
+    def __init__(self, url, token=None, codec="bz2", max_connections=8,
+                 retries=5, backoff=0.5):
+        parsed = urlparse.urlparse(url)
+        if parsed.scheme == "https":
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.netloc = parsed.netloc
+        self.path = parsed.path.rstrip("/")
+        self.token = token
+        self.codec = compression.Codec(codec)
+        self.concurrency = max_connections
+        self.connections = Queue.LifoQueue()
+        self.semaphore = threading.BoundedSemaphore(max_connections)
+        self.retries = retries
+        self.backoff = backoff
+        self.known = set()
+
+    def _connection(self):
+        try:
+            return self.connections.get_nowait()
+        except Queue.Empty:
+            return self.connection_class(self.netloc, timeout=60)
+
+    def close(self):
+        """ Close idle connections """
+        while True:
+            try:
+                self.connections.get_nowait().close()
+            except Queue.Empty:
+                return
+
+    def _request(self, method, name=None, body=None, headers=None,
+                 query=None):
+        """ Send a request and return the response and its body
+
+        Retries requests failing with connection errors or server errors. """
+        path = self.path
+        if name:
+            path += "/" + urllib.quote(name)
+        if query:
+            path += "?" + urllib.urlencode(query)
+        headers = dict(headers or {})
+        if self.token:
+            headers['X-Auth-Token'] = self.token
+        with self.semaphore, stats.timer("backend_request"):
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    stats.add("backend_retries")
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+                connection = self._connection()
+                try:
+                    connection.request(method, path, body, headers)
+                    response = connection.getresponse()
+                    data = response.read()
+                except (httplib.HTTPException, socket.error) as e:
+                    connection.close()
+                    error = e
+                    continue
+                self.connections.put(connection)
+                if response.status < 500:
+                    return response, data
+                error = IOError("%s %s failed: %s %s" % (
+                    method, path, response.status, response.reason))
+            raise error
+
+    def _check(self, response, name):
+        if response.status == 404:
+            raise IOError(errno.ENOENT, "Object not found", name)
+        if response.status // 100 != 2:
+            raise IOError("Request for %s failed: %s %s" % (
+                name, response.status, response.reason))
+
+    def put(self, name, data):
+        """ Write an object if not yet existing """
+        if name in self.known:
+            return False
+        data = self.codec.compress(data)
+        headers = {'If-None-Match': '*'}
+        response, _ = self._request("PUT", name, data, headers)
+        if response.status == 404:  # container does not yet exist
+            self._check(self._request("PUT")[0], self.path)
+            response, _ = self._request("PUT", name, data, headers)
+        if response.status == 412:
+            stored = False
+        else:
+            self._check(response, name)
+            stored = True
+        if name[0] != "b":
+            self.known.add(name)
+        return stored
+
+    def get(self, name):
+        """ Read an object """
+        response, data = self._request("GET", name)
+        self._check(response, name)
+        return compression.decompress(data)
+
+    def exists(self, name):
+        """ Return True if an object exists """
+        if name in self.known:
+            return True
+        response, _ = self._request("HEAD", name)
+        if response.status == 404:
+            return False
+        self._check(response, name)
+        return True
+
+    def delete(self, name):
+        """ Delete an object """
+        self.known.discard(name)
+        response, _ = self._request("DELETE", name)
+        self._check(response, name)
+
+    def size(self, name):
+        """ Return the stored size of an object """
+        response, _ = self._request("HEAD", name)
+        self._check(response, name)
+        return int(response.getheader("Content-Length"))
+
+    def list(self, prefix=""):
+        """ List objects, filtering with prefix if given
+
+        Only names starting with the literal part of the prefix are requested
+        from the container, one page at a time. Returns an iterator. """
+        literal = re.split(r"[*?[]", prefix, 1)[0]
+        marker = ""
+        while True:
+            query = {'prefix': literal, 'marker': marker,
+                     'limit': self.list_limit}
+            response, data = self._request("GET", query=query)
+            if response.status == 404:  # container does not yet exist
+                return
+            self._check(response, self.path)
+            names = data.splitlines()
+            if not names:
+                return
+            for name in fnmatch.filter(names, prefix or "*"):
+                yield name
+            marker = names[-1]
+
+
+def _makedirs(path):
+    """ Create a directory and its parents unless it exists """
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def _listdir(path):
+    """ Return names in path, or an empty list if path does not exist """
+    try:
+        return os.listdir(path)
+    except OSError as e:
+        if e.errno in (errno.ENOENT, errno.ENOTDIR):
+            return []
+        raise
@@ -0,0 +1,324 @@
+#!/usr/bin/python
+"""
+Copyright 2014 Christian Schwede.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from cStringIO import StringIO
+
+from safebox import backends, common, stats, utils
+
+BENCHMARK_VERSION = 1
+
+# Operations are compared by these metrics; more is worse for all of them
+COMPARED_METRICS = ["seconds", "read_write_calls", "max_rss_kb"]
+# Scenarios are compared by these metrics; less is worse for all of them
+COMPARED_SCENARIO_METRICS = ["dedup_ratio"]
+DEFAULT_THRESHOLD = 0.1
+
+
+def random_data(rng, size):
+    """ Returns size pseudo-random bytes, reproducible by the seed of rng """
+    if size <= 0:
+        return ""
+    return ("%0*x" % (size * 2, rng.getrandbits(size * 8))).decode("hex")
+
+
+def write_random(filename, rng, size, block_size=2 ** 20):
+    with open(filename, "wb") as outfile:
+        while size > 0:
+            outfile.write(random_data(rng, min(size, block_size)))
+            size -= block_size
+
+
+def patch_file(filename, rng, count=3, length=100):
+    """ Overwrites a few small regions of a file """
+    size = os.path.getsize(filename)
+    with open(filename, "r+b") as outfile:
+        for _ in range(count):
+            outfile.seek(rng.randrange(max(size - length, 1)))
+            outfile.write(random_data(rng, length))
+
+
+def small_files(path, rng, scale):
+    """ Many small files in a few directories """
+    for i in range(max(int(2000 * scale), 1)):
+        directory = os.path.join(path, "dir%02d" % (i % 20))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        write_random(os.path.join(directory, "file%05d" % i), rng,
+                     rng.randint(1, 8192))
+
+
+def modify_small_files(path, rng, scale):
+    count = max(int(2000 * scale), 1)
+    for i in range(0, count, 50):
+        filename = os.path.join(path, "dir%02d" % (i % 20), "file%05d" % i)
+        write_random(filename, rng, rng.randint(1, 8192))
+
+
+def large_files(path, rng, scale):
+    """ A few large files, modified in small regions """
+    for i in range(4):
+        write_random(os.path.join(path, "large%d" % i), rng,
+                     max(int(16 * 2 ** 20 * scale), 1))
+
+
+def modify_large_files(path, rng, scale):
+    for i in range(4):
+        patch_file(os.path.join(path, "large%d" % i), rng)
+
+
+def sparse_files(path, rng, scale):
+    """ Large files consisting mostly of holes """
+    size = max(int(32 * 2 ** 20 * scale), 2)
+    for i in range(4):
+        filename = os.path.join(path, "sparse%d" % i)
+        with open(filename, "wb") as outfile:
+            outfile.write(random_data(rng, min(2 ** 20, size / 2)))
+            outfile.seek(size - min(2 ** 20, size / 2))
+            outfile.write(random_data(rng, min(2 ** 20, size / 2)))
+
+
+def modify_sparse_files(path, rng, scale):
+    patch_file(os.path.join(path, "sparse0"), rng)
+
+
+def duplicate_files(path, rng, scale):
+    """ Files composed of a small set of repeated blocks """
+    blocks = [random_data(rng, 64 * 1024) for _ in range(8)]
+    for i in range(32):
+        with open(os.path.join(path, "dup%02d" % i), "wb") as outfile:
+            for _ in range(max(int(32 * scale), 1)):
+                outfile.write(rng.choice(blocks))
+
+
+def modify_duplicate_files(path, rng, scale):
+    with open(os.path.join(path, "dup00"), "ab") as outfile:
+        outfile.write(random_data(rng, 64 * 1024))
+
+
+# Scenario name: (function creating the tree, function modifying it)
+SCENARIOS = {
+    "small_files": (small_files, modify_small_files),
+    "large_files": (large_files, modify_large_files),
+    "sparse_files": (sparse_files, modify_sparse_files),
+    "duplicate_files": (duplicate_files, modify_duplicate_files),
+}
+
+
+def io_counters():
+    """ Returns I/O counters of this process from /proc/self/io """
+    counters = {}
+    try:
+        with open("/proc/self/io") as infile:
+            for line in infile:
+                key, _, value = line.partition(":")
+                counters[key] = int(value)
+    except (IOError, ValueError):
+        pass
+    return counters
+
+
+def directory_size(path):
+    """ Returns the size of all files in path, as stored on disk """
+    size = 0
+    for _, stat in utils.iter_files(path):
+        size += getattr(stat, "st_blocks", 0) * 512
+    return size
+
+
+# Function measured by the process of measure()
+_measured = None
+
+
+def _init_measured(func, args, kwargs):
+    global _measured
+    _measured = (func, args, kwargs)
+
+
+def _run_measured():
+    func, args, kwargs = _measured
+    stats.reset()
+    before = io_counters()
+    start = time.time()
+    result = func(*args, **kwargs)
+    seconds = time.time() - start
+    after = io_counters()
+    snapshot = stats.snapshot()
+    metrics = {
+        'seconds': round(seconds, 4),
+        'max_rss_kb': max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+        'counters': snapshot['counters'],
+        'timers': snapshot['timers'],
+    }
+    for key in ["syscr", "syscw", "rchar", "wchar", "read_bytes",
+                "write_bytes"]:
+        if key in after:
+            metrics[key] = after[key] - before.get(key, 0)
+    if "syscr" in metrics:
+        metrics['read_write_calls'] = metrics['syscr'] + metrics['syscw']
+    return result, metrics
+
+
+def measure(func, *args, **kwargs):
+    """ Runs func in a new process and returns its result and the measured
+    metrics
+
+    Metrics include the counters and phase timers of safebox.stats and the
+    I/O counters of the process; read_write_calls only counts read and
+    write system calls, as reported by /proc/self/io. max_rss_kb is the
+    peak memory usage of the process, which starts with the memory used by
+    the calling process. Results must be picklable, while changes of other
+    objects in memory are lost. """
+    with utils.ProcessPool(1, _init_measured, (func, args, kwargs)) as pool:
+        return pool.submit(_run_measured).result()
+
+
+def run_scenario(name, workdir, scale=1.0, workers=common.DEFAULT_WORKERS,
+                 seed=0):
+    """ Runs all benchmarked operations on a new tree of a scenario.
+
+    Returns a dict of the metrics of every operation, the size of the
+    source tree and the storage, and the resulting dedup ratio. """
+    generate, modify = SCENARIOS[name]
+    rng = random.Random(seed)
+    src = os.path.join(workdir, "src")
+    storage = os.path.join(workdir, "storage")
+    dst = os.path.join(workdir, "dst")
+    files_cache = os.path.join(workdir, "files-cache")
+    for path in [src, storage, dst]:
+        os.makedirs(path)
+    generate(src, rng, scale)
+    source_bytes = sum(stat.st_size for _, stat in utils.iter_files(src))
+
+    def backend():
+        # Every operation runs in a process of its own, see measure(), and
+        # needs a backend with an up to date index
+        return backends.LocalStorage(storage)
+
+    operations = {}
+    backup_id, operations['backup'] = measure(
+        common.backup, backend(), src, workers=workers,
+        files_cache=files_cache)
+    operations['backup']['bytes'] = source_bytes
+    modify(src, rng, scale)
+    backup_id, operations['backup_incremental'] = measure(
+        common.backup, backend(), src, workers=workers,
+        files_cache=files_cache)
+    _, operations['restore'] = measure(
+        common.restore, backend(), dst, backup_id, workers=workers)
+    operations['restore']['bytes'] = source_bytes
+    _, operations['restore_incremental'] = measure(
+        common.restore, backend(), dst, backup_id, workers=workers,
+        incremental=True)
+    stored_bytes = directory_size(storage)
+
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        _, operations['list'] = measure(
+            common.list_backups, backend(), storage, backup_id)
+    finally:
+        sys.stdout = stdout
+    storage_backend = backend()
+    storage_backend.delete_many(
+        [os.path.basename(b) for b in storage_backend.list("b-*")
+         if os.path.basename(b) != backup_id])
+    _, operations['gc'] = measure(common.gc, backend(), workers=workers)
+
+    for metrics in operations.values():
+        if metrics.get('bytes') and metrics['seconds']:
+            metrics['mb_per_s'] = round(
+                metrics['bytes'] / metrics['seconds'] / 2 ** 20, 2)
+    return {
+        'operations': operations,
+        'source_bytes': source_bytes,
+        'stored_bytes': stored_bytes,
+        'dedup_ratio': round(float(source_bytes) / max(stored_bytes, 1), 3),
+    }
+
+
+def run(scenarios=None, scale=1.0, workers=common.DEFAULT_WORKERS, seed=0,
+        workdir=None):
+    """ Runs the given scenarios, or all, and returns the results.
+
+    Every scenario uses a new temporary directory below workdir. Logging
+    of single files is disabled while running. """
+    results = {
+        'version': BENCHMARK_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': scale,
+        'workers': workers,
+        'seed': seed,
+        'scenarios': {},
+    }
+    logging.disable(logging.INFO)
+    try:
+        for name in sorted(scenarios or SCENARIOS):
+            tempdir = tempfile.mkdtemp(prefix="safebox-benchmark-",
+                                       dir=workdir)
+            try:
+                results['scenarios'][name] = run_scenario(
+                    name, tempdir, scale, workers, seed)
+            finally:
+                shutil.rmtree(tempdir)
+    finally:
+        logging.disable(logging.NOTSET)
+    return results
+
+
+def compare(old, new, threshold=DEFAULT_THRESHOLD):
+    """ Returns regressions of new results compared to old results.
+
+    A regression is a (scenario, operation, metric, old value, new value)
+    tuple for every compared metric that got worse by more than threshold,
+    as a fraction of the old value. Metrics of whole scenarios are reported
+    with "scenario" as operation. """
+    regressions = []
+    for name, scenario in sorted(new['scenarios'].items()):
+        old_scenario = old['scenarios'].get(name)
+        if not old_scenario:
+            continue
+        for metric in COMPARED_SCENARIO_METRICS:
+            old_value = old_scenario.get(metric)
+            value = scenario.get(metric)
+            if old_value is None or value is None:
+                continue
+            if value < old_value * (1 - threshold):
+                regressions.append(
+                    (name, "scenario", metric, old_value, value))
+        for operation, metrics in sorted(scenario['operations'].items()):
+            old_metrics = old_scenario['operations'].get(operation, {})
+            for metric in COMPARED_METRICS:
+                old_value = old_metrics.get(metric)
+                value = metrics.get(metric)
+                if old_value is None or value is None:
+                    continue
+                if value > old_value * (1 + threshold):
+                    regressions.append(
+                        (name, operation, metric, old_value, value))
+    return regressions
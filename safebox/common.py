@@ -17,173 +17,964 @@ limitations under the License.
 """
 from datetime import datetime
 from string import ascii_letters, digits
+import collections
+import fnmatch
 import hashlib
-import json
 import logging
 import os
 import random
+import re
+import tempfile
 import time
 
-from stat import S_ISREG
+from stat import S_ISDIR, S_ISREG
 
 from rabin import rabin
-from safebox import utils
+from safebox import manifest, stats, utils
 
 
-def backup(backend, src, tag="default"):
-    # Try to load old metadata from latest backup
-    old_backups = backend.list(prefix="b-*")
-    old_meta_data = {}
-    if old_backups:
-        backup_id = utils.newest_backup_id(old_backups)
-        om = backend.get(backup_id)
-        try:
-            old_meta_data = json.loads(om)
-        except ValueError:
-            pass
+DEFAULT_WORKERS = 4
 
-    start_time = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-    path = os.path.expanduser(src)
-    files = utils.find_modified_files(path)
-    chunk_size = chunk_count = changed_bytes = 0
-    for filename, meta in files.items():
-        # Assume file is unchanged if neither mtime nor size is changed
-        old = old_meta_data.get(unicode(filename, 'utf-8'))
-        if old and old['m'] == meta['m'] and old['s'] == meta['s']:
-            old_checksum = old.get('c')
-            if old_checksum:
-                meta['c'] = old_checksum
-            logging.info("Skipped unchanged %s" % filename)
-            continue
 
-        fullname = os.path.join(path, filename)
-        if not S_ISREG(meta['p']):  # not a file
+def load_manifest(backend, backup_id, pool=None):
+    """ Returns a manifest.Manifest or manifest.Tree of the given backup.
+
+    Trees are read ahead using the given pool, see Storage.get_many(). """
+    return manifest.load(backend.get(backup_id), backend.get,
+                         lambda names: backend.get_many(names, pool))
+
+
+HINT_MIN_SIZE = 4 * 2 ** 20
+
+# Changed data of files split along their previous chunks is split into
+# content-defined chunks in windows of this size, see read_hinted_chunks()
+HINT_RESYNC_SIZE = 2 ** 20
+
+
+# Chunks containing only zeros are listed by this name and size, but are
+# not stored. They are restored as holes in sparse files.
+ZERO_CHUNK = "zero"
+
+
+def store_chunk(backend, data, checksum=None):
+    """ Hash and store a single chunk. Executed by the backup workers. """
+    if not checksum:
+        with stats.timer("hash"):
+            checksum = utils.sha256_string(data)
+    stored = backend.put("c-%s" % checksum, data)
+    return checksum, len(data), stored
+
+
+def submit_chunk(backend, pool, data, checksum=None):
+    """ Returns a job storing a chunk, unless it contains only zeros """
+    if data and not data.strip("\0"):
+        return utils.Job.finished((ZERO_CHUNK, len(data), False))
+    return pool.submit(store_chunk, backend, data, checksum)
+
+
+def content_defined_sizes(fullname):
+    """ Returns the sizes of the content-defined chunks of a file.
+
+    rabin() reads the whole file by itself and returns all sizes at once;
+    it has no incremental interface to feed it data already read. """
+    with stats.timer("chunk"):
+        return rabin(fullname)
+
+
+def window_sizes(data):
+    """ Returns the sizes of the content-defined chunks of data.
+
+    rabin() only accepts a filename, thus data is written to a temporary
+    file first. """
+    with tempfile.NamedTemporaryFile(prefix="safebox-") as tmpfile:
+        tmpfile.write(data)
+        tmpfile.flush()
+        return content_defined_sizes(tmpfile.name)
+
+
+def chunk_checksum(data):
+    """ Returns the checksum of a chunk, or ZERO_CHUNK if it contains only
+    zeros """
+    with stats.timer("hash"):
+        if not data.strip("\0"):
+            return ZERO_CHUNK
+        return utils.sha256_string(data)
+
+
+class ChunkedFile(object):
+    """ The checksum and chunks of a file read in the calling thread.
+
+    Chunks are stored by jobs of a pool. Results of finished jobs are kept
+    as compact (checksum, length, stored) records in the order of the
+    chunks, thus only the jobs still in progress are kept. Provides the
+    interface of a job running store_file(). """
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.records = []
+        self.jobs = collections.deque()
+
+    def _collect(self, wait=False):
+        while self.jobs and (wait or self.jobs[0].done()):
+            self.records.append(self.jobs.popleft().result())
+
+    def add(self, job):
+        """ Adds the job storing the next chunk """
+        self.jobs.append(job)
+        self._collect()
+
+    def done(self):
+        self._collect()
+        return not self.jobs
+
+    def result(self):
+        self._collect(wait=True)
+        return self.sha256.hexdigest(), self.records, None
+
+
+def read_chunks(backend, pool, infile, fullname):
+    """ Split a file into content-defined chunks and store them.
+
+    The chunk sizes are computed from fullname first, and the chunks are then
+    read from infile; changed files are thus read twice, see
+    content_defined_sizes(). Returns a ChunkedFile. """
+    chunked = ChunkedFile()
+    sizes = content_defined_sizes(fullname)
+    for _, data in stats.timed_iter("read", utils.iter_chunks(infile, sizes)):
+        with stats.timer("hash"):
+            chunked.sha256.update(data)
+        chunked.add(submit_chunk(backend, pool, data))
+    return chunked
+
+
+def read_hinted_chunks(backend, pool, infile, hints):
+    """ Split a file along the chunks of its previous version and store them.
+
+    hints is the chunk list of the previous version, see chunk_list(). Every
+    previous chunk is compared by its checksum at its expected offset; after
+    a changed chunk that offset is shifted by the change of the file size.
+    Unchanged chunks are thus neither stored nor looked up again, and
+    neither changes in place nor a single inserted or removed range need any
+    rolling checksums. Changed data is stored along the previous chunk
+    boundaries. Previous chunks are known to exist as long as their chunk
+    list does, see gc().
+
+    If two chunks in a row changed, or after the last previous chunk, the
+    following data is split into content-defined chunks in windows of
+    HINT_RESYNC_SIZE bytes, until one of them is a previous chunk again.
+    Returns a ChunkedFile. """
+    chunked = ChunkedFile()
+    # Previous offsets of the hints, and their indexes by checksum
+    starts = []
+    found = collections.defaultdict(list)
+    position = 0
+    for i, (checksum, length) in enumerate(hints):
+        starts.append(position)
+        position += length
+        if checksum != ZERO_CHUNK:
+            found[checksum].append(i)
+    size = os.fstat(infile.fileno()).st_size
+    delta = size - position
+    max_length = max(length for _, length in hints)
+
+    def read(length):
+        with stats.timer("read"):
+            data = infile.read(length)
+        with stats.timer("hash"):
+            chunked.sha256.update(data)
+        return data
+
+    def resync(offset, current):
+        """ Returns the offset after the next previous chunk found in the
+        data from offset on, and the index of that chunk """
+        while True:
+            with stats.timer("read"):
+                window = infile.read(HINT_RESYNC_SIZE)
+            if not window:
+                return offset, None
+            sizes = window_sizes(window)
+            if len(window) == HINT_RESYNC_SIZE and len(sizes) > 1:
+                sizes.pop()  # ends at the window, not at a chunk boundary
+            position = 0
+            for length in sizes:
+                data = window[position:position + length]
+                position += length
+                offset += length
+                checksum = chunk_checksum(data)
+                with stats.timer("hash"):
+                    chunked.sha256.update(data)
+                if checksum in found:
+                    chunked.add(utils.Job.finished((checksum, length, False)))
+                    infile.seek(offset)
+                    indexes = found[checksum]
+                    return offset, next(
+                        (i for i in indexes if i >= current), indexes[0])
+                chunked.add(submit_chunk(backend, pool, data, checksum))
+            infile.seek(offset)
+
+    i = offset = shift = misses = 0
+    while True:
+        if misses > 1 or i == len(hints):
+            offset, i = resync(offset, i)
+            if i is None:
+                return chunked
+            shift = offset - starts[i] - hints[i][1]
+            i += 1
+            misses = 0
             continue
+        old_checksum, length = hints[i]
+        start = starts[i] + shift
+        i += 1
+        if start < offset or start + length > size:
+            continue  # overlaps data already read, or beyond the end
+        if start - offset > HINT_RESYNC_SIZE:
+            misses = 2
+            continue
+        # Data inserted in front of a shifted chunk
+        while offset < start:
+            data = read(min(start - offset, max_length))
+            if not data:  # truncated while reading
+                return chunked
+            chunked.add(submit_chunk(backend, pool, data))
+            offset += len(data)
+        data = read(length)
+        if not data:
+            return chunked
+        offset += len(data)
+        checksum = chunk_checksum(data)
+        if len(data) == length and checksum == old_checksum:
+            chunked.add(utils.Job.finished((checksum, length, False)))
+            misses = 0
+        else:
+            chunked.add(submit_chunk(backend, pool, data, checksum))
+            misses += 1
+            shift = delta
 
-        my_sha256 = hashlib.sha256()
 
-        chunk_checksums = []
+# Backend used by the processes of a backup, see backup()
+_process_backend = None
+
+# Number of pending files per backup process
+PROCESS_QUEUE_SIZE = 16
+
+
+def _init_process(backend):
+    global _process_backend
+    _process_backend = backend
+    # Stats and their lock are inherited from the parent process as well
+    stats.current.__init__()
+    # Connections inherited from the parent process must not be shared
+    backend.close()
+
+
+def store_file(fullname, hints=None):
+    """ Chunk, hash and store a whole file. Executed by backup processes.
+
+    Returns the file checksum, a (checksum, length, stored) record for every
+    chunk and a snapshot of the stats of this process, or None if the file
+    could not be read. """
+    stats.reset()
+    pool = utils.WorkerPool(_process_backend.concurrency)
+    try:
+        with open(fullname, 'rb') as infile:
+            if hints:
+                chunked = read_hinted_chunks(
+                    _process_backend, pool, infile, hints)
+            else:
+                chunked = read_chunks(
+                    _process_backend, pool, infile, fullname)
+        checksum, records, _ = chunked.result()
+    except IOError:
+        return None
+    finally:
+        pool.close()
+        _process_backend.flush()
+    return checksum, records, stats.snapshot()
+
+
+def generation(backend):
+    """ Returns the names of the generation markers of a repository.
+
+    gc() replaces the marker before removing any object. Object names
+    remembered locally, see utils.FileCache, are thus known to exist as long
+    as the generation is unchanged, without looking up every object. """
+    return tuple(sorted(
+        os.path.basename(name) for name in backend.list("g-*")))
+
+
+def source_names(sources):
+    """ Returns (name, path) tuples of the sources of a backup, sorted by
+    name.
+
+    Every source is stored as a top-level entry named after its basename,
+    names of directories end with a slash. Raises ValueError if a source
+    does not exist, or if two sources have the same name. """
+    named = {}
+    paths = {}
+    for src in sources:
+        path = os.path.expanduser(src)
+        name = os.path.basename(os.path.normpath(os.path.abspath(path)))
+        if not name or not manifest.valid_path(name):
+            raise ValueError("%s can not be backed up with other sources" %
+                             src)
+        if name in paths:
+            raise ValueError("%s and %s are both named %s" % (
+                             paths[name], src, name))
         try:
-            chunks = rabin(fullname)
-        except IOError:
-            logging.warning("%s not found, skipping" % fullname)
-            continue
-        with open(fullname) as infile:
-            for chunksize in chunks:
-                data = infile.read(chunksize)
-                my_sha256.update(data)
-                chunk_checksum = utils.sha256_string(data)
-                name = "c-%s" % chunk_checksum
-                chunk_checksums.append(chunk_checksum)
-                stored = backend.put(name, data)
-                changed_bytes += len(data)
+            stat = os.stat(path)
+        except OSError as e:
+            raise ValueError("%s: %s" % (src, e.strerror))
+        paths[name] = src
+        if S_ISDIR(stat.st_mode):
+            name += "/"
+        named[name] = path
+    return sorted(named.items())
+
+
+def iter_sources(named, workers=0):
+    """ Yields the entries of multiple sources like utils.iter_files().
+
+    The entries of a directory follow the entry of the directory itself. """
+    for name, path in named:
+        yield name, os.stat(path)
+        if name.endswith("/"):
+            for filename, stat in utils.iter_files(path, workers=workers):
+                yield name + filename, stat
+
+
+def backup(backend, src, tag="default", workers=DEFAULT_WORKERS,
+           files_cache=None, processes=0):
+    """ Backup all files and directories found in src.
+
+    src is a single path or a list of paths. The entries of a single path
+    are stored at the top of the backup, while multiple paths are stored
+    as top-level files or directories named after their basenames, see
+    source_names(). Sources are validated before anything is stored; all of
+    them are scanned and stored in a single pass, sharing the workers, the
+    latest backup and the resulting manifest.
+
+    Files are read and chunked in the calling thread, while hashing and
+    storing chunks is done by a pool of workers. Chunk checksums are collected
+    in the order they were read, thus the resulting metadata is independent of
+    the number of workers used.
+
+    Files are found in sorted order and joined with the sorted entries of
+    the latest backup, therefore neither of them is kept in memory.
+
+    If files_cache is given, it names a local utils.FileCache used to detect
+    unchanged files. The manifest of the latest backup is not needed then,
+    unless gc() removed objects since the cache was saved, see generation().
+
+    Metadata is stored as one tree object per directory, see
+    manifest.TreeWriter; only trees of changed directories are new and
+    stored. Previous trees are taken from the latest backup, or from the
+    files cache.
+
+    If processes is given, changed files are read, chunked, hashed and
+    stored by as many processes instead, each of them handling whole files.
+    Only the checksums and sizes of the chunks are sent back to the calling
+    process. The backend must be process_safe then. """
+    if processes and not backend.process_safe:
+        raise ValueError("%s can not be used by multiple processes" %
+                         type(backend).__name__)
+    roots = None
+    if not isinstance(src, basestring):
+        named = source_names(src)
+        roots = dict((name.rstrip("/"), path) for name, path in named)
+    cache = None
+    if files_cache:
+        cache = utils.FileCache(files_cache, generation(backend))
+
+    start_time = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+    if roots is None:
+        path = os.path.expanduser(src)
+        scan = utils.iter_files(path, workers=workers)
+    else:
+        scan = iter_sources(named, workers=workers)
+
+    def source_path(filename):
+        """ Returns the path of an entry in the filesystem """
+        if roots is None:
+            return os.path.join(path, filename)
+        name, _, filename = filename.partition("/")
+        if not filename:
+            return roots[name]
+        return os.path.join(roots[name], filename)
+
+    totals = {'chunk_size': 0, 'chunk_count': 0, 'changed_bytes': 0}
+    tree_jobs = []
+    pending = collections.deque()
+
+    def finish(filename, stat, meta, job, previous=None):
+        if job is not None:
+            result = job.result()
+            if result is None:
+                logging.warning("%s not found, skipping" %
+                                source_path(filename))
+                return
+            checksum, records, process_stats = result
+            if process_stats:
+                stats.merge(process_stats)
+            chunk_checksums = []
+            for chunk_checksum, length, stored in records:
+                chunk_checksums.append((chunk_checksum, length))
+                totals['changed_bytes'] += length
+                stats.add("chunks")
                 if stored:
-                    chunk_size += len(data)
-                    chunk_count += 1
-        if len(chunk_checksums) > 1:
-            checksum = my_sha256.hexdigest()
-            name = "o-%s" % checksum
-            backend.put(name, ';'.join(chunk_checksums))
-        else:
-            name = "c-%s" % chunk_checksums[0]
-        meta['c'] = name
-        logging.info(fullname)
+                    totals['chunk_size'] += length
+                    totals['chunk_count'] += 1
+                    stats.add("new_chunks")
+                    stats.add("new_chunk_bytes", length)
+            if len(chunk_checksums) > 1 or \
+                    chunk_checksums[0][0] == ZERO_CHUNK:
+                name = "o-%s" % checksum
+                backend.put(name, ';'.join(
+                    "%s:%d" % item for item in chunk_checksums))
+            else:
+                name = "c-%s" % chunk_checksums[0][0]
+            meta['c'] = name
+            logging.debug(source_path(filename))
+            stats.add("changed_files")
+        if cache and meta.get('c'):
+            cache.add(stat, meta['c'])
+        writer.add(filename, meta, previous)
+
+    # Processes are forked before any worker threads are started
+    process_pool = None
+    if processes:
+        process_pool = utils.ProcessPool(
+            processes, _init_process, (backend, ))
+    pool = utils.WorkerPool(workers)
+    try:
+        # Try to load old metadata from latest backup; its trees are read
+        # ahead by the pool of workers
+        old_entries = []
+        old_root = cache.tree("") if cache else None
+        if not (cache and cache.entries):
+            backup_id = utils.newest_backup_id(backend.list(prefix="b-*"))
+            if backup_id:
+                try:
+                    old_meta_data = load_manifest(backend, backup_id, pool)
+                    old_root = getattr(old_meta_data, "name", None)
+                    old_entries = old_meta_data.items()
+                except ValueError:
+                    pass
+        files = utils.merge_join(
+            stats.timed_iter("scan", scan),
+            ((manifest.encode_path(filename), entry)
+             for filename, entry in old_entries))
+        writer = manifest.TreeWriter(
+            lambda name, data: tree_jobs.append(
+                pool.submit(backend.put, name, data)), old_root,
+            cache.add_tree if cache else None)
+
+        for filename, stat, old in files:
+            # Entries are written in order, after all chunks of preceding
+            # files are stored
+            while pending and (pending[0][3] is None or pending[0][3].done()):
+                finish(*pending.popleft())
+            if process_pool:
+                while len(pending) >= processes * PROCESS_QUEUE_SIZE:
+                    finish(*pending.popleft())
+
+            # Paths are stored as UTF-8, other names could not be restored
+            if not manifest.valid_path(filename):
+                logging.warning("%s is not a valid UTF-8 name, skipping" %
+                                source_path(filename))
+                continue
+
+            meta = utils.stat2dict(stat)
+            stats.add("files")
+            if not S_ISREG(meta['p']):  # not a file
+                previous = None
+                if S_ISDIR(meta['p']):
+                    previous = old.get('c') if old else \
+                        cache.tree(filename) if cache else None
+                pending.append((filename, stat, meta, None, previous))
+                continue
+            stats.add("bytes", meta['s'])
+
+            # Assume file is unchanged if neither ctime, mtime nor size of
+            # its inode is changed, or if neither mtime nor size is changed
+            # compared to the latest backup
+            cached = cache.get(stat) if cache else None
+            if cached:
+                old = {'m': meta['m'], 's': meta['s'], 'c': cached}
+            if old and old['m'] == meta['m'] and old['s'] == meta['s']:
+                old_checksum = old.get('c')
+                if old_checksum:
+                    meta['c'] = old_checksum
+                logging.debug("Skipped unchanged %s" % filename)
+                stats.add("unchanged_files")
+                pending.append((filename, stat, meta, None))
+                continue
+
+            # Chunks of the previous version of large files are compared
+            # first, unchanged data is not chunked again
+            hints = None
+            previous = old.get('c') if old else \
+                cache.previous(stat) if cache else None
+            if meta['s'] >= HINT_MIN_SIZE and previous and \
+                    previous.startswith('o-') and backend.exists(previous):
+                hints = chunk_list(backend, previous)
+                if None in (size for _, size in hints):
+                    hints = None  # written by an earlier version
+
+            fullname = source_path(filename)
+            if process_pool:
+                pending.append((filename, stat, meta,
+                                process_pool.submit(store_file, fullname,
+                                                    hints)))
+                continue
+            try:
+                infile = open(fullname, 'rb')
+            except IOError:
+                logging.warning("%s not found, skipping" % fullname)
+                continue
+            with infile:
+                try:
+                    if hints:
+                        chunked = read_hinted_chunks(
+                            backend, pool, infile, hints)
+                    else:
+                        chunked = read_chunks(
+                            backend, pool, infile, fullname)
+                except IOError:
+                    logging.warning("%s not found, skipping" % fullname)
+                    continue
+            pending.append((filename, stat, meta, chunked))
+        while pending:
+            finish(*pending.popleft())
+        meta_data = writer.getvalue()
+    finally:
+        if process_pool:
+            process_pool.close()
+        pool.close()
+        backend.flush()
+    for job in tree_jobs:
+        job.result()
 
     # write backup summary
-    meta_data = json.dumps(files)
     suffix = ''.join(random.choice(ascii_letters + digits) for _ in range(8))
     backup_id = "b-%s-%s-%s" % (tag, start_time, suffix)
     backend.put(backup_id, meta_data)
     logging.info("Finished backup %s. %s bytes changed" % (
-                 backup_id, changed_bytes))
+                 backup_id, totals['changed_bytes']))
     logging.info("Stored %s new objects with a total size of %s bytes" % (
-                 chunk_count, chunk_size))
+                 totals['chunk_count'], totals['chunk_size']))
+    if cache:
+        cache.save()
     return backup_id
 
 
-def restore(backend, dst, backup_id):
+RESTORE_READ_AHEAD = 32
+RESTORE_CACHE_SIZE = 64 * 2 ** 20
+RESTORE_TMP_PREFIX = ".safebox-"
+EMPTY_CHECKSUM = hashlib.sha256("").hexdigest()
+
+
+def chunk_list(backend, name):
+    """ Returns (checksum, size) tuples of the chunks listed in an object.
+
+    Sizes are None if the object was written by an earlier version. """
+    return parse_chunk_list(backend.get(name))
+
+
+def parse_chunk_list(data):
+    """ Returns (checksum, size) tuples of the content of a chunk list """
+    result = []
+    for item in data.split(';'):
+        checksum, _, size = item.partition(':')
+        result.append((checksum, int(size) if size else None))
+    return result
+
+
+def file_chunks(backend, entry):
+    """ Returns (chunk name, size) tuples of a file entry.
+
+    The name is None for extents filled with zeros, which are not stored at
+    all. """
+    content = entry['c']
+    if content.startswith('o-'):
+        return [(None if chunk == ZERO_CHUNK else "c-" + chunk, size)
+                for chunk, size in chunk_list(backend, content)]
+    return [(content, entry['s'])]
+
+
+def _matches(path, patterns):
+    """ Returns True if path or one of its parent directories matches one of
+    the glob patterns """
+    path = path.rstrip("/")
+    while path:
+        if any(fnmatch.fnmatchcase(path, pattern) for pattern in patterns):
+            return True
+        path = path.rpartition("/")[0]
+    return False
+
+
+def select_entries(meta_data, include=None, exclude=None):
+    """ Yields (path, entry) tuples of a manifest matching the filters.
+
+    Filters are glob patterns matched against paths relative to the backup.
+    Entries are selected if they or one of their parent directories match
+    any include pattern, or if there are none, unless they or one of their
+    parents match an exclude pattern. Directories which can't contain any
+    selected entry are skipped without reading their content. """
+    include = [manifest.encode_path(p).strip("/") for p in include or []]
+    exclude = [manifest.encode_path(p).strip("/") for p in exclude or []]
+    literals = [re.split(r"[*?[]", pattern, 1)[0] for pattern in include]
+
+    def selected(path):
+        if exclude and _matches(path, exclude):
+            return False
+        return not include or _matches(path, include)
+
+    def descend(path, entry):
+        path = manifest.encode_path(path)
+        if exclude and _matches(path, exclude):
+            return False
+        return selected(path) or any(
+            path.startswith(literal) or literal.startswith(path)
+            for literal in literals)
+
+    for path, entry in meta_data.items(descend):
+        if selected(manifest.encode_path(path)):
+            yield path, entry
+
+
+def scan_existing(filename):
+    """ Split an existing file into chunks the same way backup does.
+
+    Returns the checksum of the file and a dict mapping chunk names to
+    their offset in the file, or None if there is no regular file. """
+    try:
+        infile = open(filename, 'rb')
+    except IOError:
+        return None
+    with infile:
+        if not S_ISREG(os.fstat(infile.fileno()).st_mode):
+            return None
+        my_sha256 = hashlib.sha256()
+        offsets = {}
+        for offset, data in utils.iter_chunks(infile, rabin(filename)):
+            my_sha256.update(data)
+            offsets.setdefault("c-%s" % utils.sha256_string(data), offset)
+    return my_sha256.hexdigest(), offsets
+
+
+def read_range(filename, offset, length):
+    """ Returns length bytes of a file starting at offset """
+    with open(filename, 'rb') as infile:
+        infile.seek(offset)
+        return infile.read(length)
+
+
+def restore(backend, dst, backup_id, workers=DEFAULT_WORKERS,
+            cache_size=RESTORE_CACHE_SIZE, include=None, exclude=None,
+            incremental=False):
+    """ Restore files and directories of a backup into dst.
+
+    Only entries matching the include and exclude patterns are restored,
+    see select_entries(). Chunk lists of all selected files are fetched
+    first to plan how often every chunk is used.
+
+    Chunks are then fetched and decompressed by a pool of workers, reading
+    ahead of the file that is currently written. Data is written
+    sequentially by the calling thread. Every chunk is fetched only once;
+    chunks needed again later are kept in memory up to cache_size bytes of
+    decompressed data, and in a temporary file beyond that.
+
+    If incremental is set, files already existing in dst are chunked like
+    in backup. Files with the same size, mtime and checksum are skipped;
+    chunks of other files are copied from the existing file if possible
+    instead of fetching them. Files are written to a new temporary file in
+    the same directory, never clashing with an existing or restored file,
+    and renamed when complete. """
     dst = os.path.expanduser(dst)
-    meta_data = backend.get(backup_id)
-    meta_data = json.loads(meta_data)
-    # sort to update directory mtime after files
-    for filename in sorted(meta_data, reverse=True):
-        entry = meta_data[filename]
-        dst_filename = os.path.join(dst, filename)
-
-        directory = os.path.dirname(dst_filename)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-
-        if S_ISREG(entry['p']):
-            with open(dst_filename, "wb") as outfile:
-                checksum = entry['c']
-                if checksum.startswith('o-'):
-                    list_of_chunks = backend.get(checksum)
-                    for chunk in list_of_chunks.split(';'):
-                        data = backend.get("c-" + chunk)
-                        outfile.write(data)
+    meta_data = load_manifest(backend, backup_id)
+    read_ahead = max(workers, 1) * RESTORE_READ_AHEAD
+    store = utils.SpillCache(cache_size)
+    fetching = {}
+    totals = {'files': 0, 'chunks': 0, 'fetched': 0, 'skipped': 0,
+             'reused': 0}
+
+    def unchanged(filename, entry, checksum):
+        try:
+            stat = os.lstat(filename)
+        except OSError:
+            return False
+        return stat.st_size == entry['s'] and \
+            abs(stat.st_mtime - entry['m']) < 0.001 and \
+            (entry.get('c') or 'c-' + EMPTY_CHECKSUM)[2:] == checksum
+
+    def plan():
+        selected = list(select_entries(meta_data, include, exclude))
+        stats.add("total_bytes", sum(entry['s'] for _, entry in selected
+                                     if S_ISREG(entry['p'])))
+        lists = set(entry['c'] for _, entry in selected
+                    if S_ISREG(entry['p']) and
+                    entry.get('c', '').startswith('o-'))
+        scans = {}
+        if incremental:
+            for filename, entry in selected:
+                if S_ISREG(entry['p']):
+                    scans[filename] = pool.submit(
+                        scan_existing, os.path.join(dst, filename))
+        chunk_lists = {}
+        for name, data in backend.get_many(lists, pool):
+            chunk_lists[name] = [
+                (None if chunk == ZERO_CHUNK else "c-" + chunk, size)
+                for chunk, size in parse_chunk_list(data)]
+        refs = collections.Counter()
+        entries = []
+        for filename, entry in selected:
+            chunks = None
+            if S_ISREG(entry['p']):
+                content = entry.get('c')
+                chunks = []
+                if content:
+                    chunks = chunk_lists.get(content, [(content, entry['s'])])
+                existing = filename in scans and scans.pop(filename).result()
+                if existing:
+                    checksum, offsets = existing
+                    if unchanged(os.path.join(dst, filename), entry,
+                                 checksum):
+                        totals['skipped'] += 1
+                        stats.add("bytes", entry['s'])
+                        continue
+                    chunks = [(name, size, offsets.get(name))
+                              for name, size in chunks]
                 else:
-                    data = backend.get(checksum)
-                    outfile.write(data)
+                    chunks = [(name, size, None) for name, size in chunks]
+                refs.update(name for name, _, offset in chunks
+                            if name and offset is None)
+            entries.append((filename, entry, chunks))
+        return entries, refs
+
+    def entries():
+        # Entries are sorted by path; directories are returned after their
+        # content to update their mtime after files
+        directories = []
+        for filename, entry, chunks in planned:
+            while directories and \
+                    not filename.startswith(directories[-1][0]):
+                yield directories.pop() + (None, )
+            if S_ISDIR(entry['p']):
+                directories.append((filename, entry))
+                continue
+            yield filename, entry, chunks
+        while directories:
+            yield directories.pop() + (None, )
 
+    def fetch(name):
+        if name in fetching:
+            return fetching[name]
+        data = store.get(name)
+        if data is not None:
+            return utils.Job.finished(data)
+        fetching[name] = pool.submit(backend.get, name)
+        totals['fetched'] += 1
+        return fetching[name]
+
+    def steps():
+        # Chunks found in the existing file are returned without a name
+        for filename, entry, chunks in entries():
+            yield filename, entry, None, None, None
+            for name, size, offset in chunks or []:
+                if offset is not None:
+                    yield filename, entry, None, size, pool.submit(
+                        read_range, os.path.join(dst, filename), offset, size)
+                else:
+                    yield filename, entry, name, size, name and fetch(name)
+
+    def finish(dst_filename, entry, tmp_filename):
+        if outfile:
+            # Extends the file if it ends with a zero-filled extent
+            outfile.truncate()
+            outfile.close()
+            if tmp_filename != dst_filename:
+                os.rename(tmp_filename, dst_filename)
         # Set mtime, owner, group, permissisons
         os.utime(dst_filename, (time.time(), entry['m']))
         os.chmod(dst_filename, entry['p'])
         os.chown(dst_filename, entry['u'], entry['g'])
-        logging.info("Restored: %s" % dst_filename)
+        totals['files'] += 1
+        stats.add("files")
+        logging.debug("Restored: %s" % dst_filename)
+
+    pool = utils.WorkerPool(workers, queue_size=read_ahead)
+    outfile = current = None
+    try:
+        with stats.timer("plan"):
+            planned, refs = plan()
+        for filename, entry, name, size, job in utils.read_ahead(
+                steps(), read_ahead):
+            if job:
+                with stats.timer("wait"):
+                    data = job.result()
+                if name:
+                    fetching.pop(name, None)
+                    refs[name] -= 1
+                    if refs[name]:
+                        store.put(name, data)
+                    else:
+                        store.pop(name)
+                    totals['chunks'] += 1
+                else:
+                    totals['reused'] += 1
+                with stats.timer("write"):
+                    outfile.write(data)
+                stats.add("bytes", len(data))
+                continue
+            if size is not None:
+                # Zero-filled extents are left as holes in sparse files
+                outfile.seek(size, os.SEEK_CUR)
+                stats.add("bytes", size)
+                continue
+            if current:
+                finish(*current)
+            dst_filename = tmp_filename = os.path.join(dst, filename)
+            directory = os.path.dirname(dst_filename)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            outfile = None
+            if S_ISREG(entry['p']):
+                if incremental:
+                    fd, tmp_filename = tempfile.mkstemp(
+                        dir=directory, prefix=RESTORE_TMP_PREFIX)
+                    outfile = os.fdopen(fd, "wb")
+                else:
+                    outfile = open(tmp_filename, "wb")
+            current = (dst_filename, entry, tmp_filename)
+        if current:
+            finish(*current)
+    finally:
+        if outfile and not outfile.closed:
+            outfile.close()
+            if current[2] != current[0]:
+                os.remove(current[2])
+        pool.close()
+        store.close()
 
+    hits = totals['chunks'] - totals['fetched']
+    logging.info("Restored %s entries of backup %s" % (
+                 totals['files'], backup_id))
+    logging.info("Used %s chunks, %s fetched, %s reused (%.1f%%)" % (
+                 totals['chunks'], totals['fetched'], hits,
+                 100.0 * hits / max(totals['chunks'], 1)))
+    if incremental:
+        logging.info("Skipped %s unchanged files, copied %s chunks from "
+                     "existing files" % (totals['skipped'], totals['reused']))
+    return totals
 
-def gc(backend):
-    backups = backend.list("b-*")
-    needed_chunks = []
-    needed_objs = []
-    for backup in backups:
-        meta_data = backend.get(backup)
-        meta_data = json.loads(meta_data)
+
+GC_BATCH_SIZE = 1000
+
+
+def gc(backend, dry_run=False, workers=DEFAULT_WORKERS):
+    """ Remove all chunks and objects that are not used by any backup.
+
+    Names referenced by backups are marked in a set first; every object
+    containing a list of chunks is only expanded once, even if it is
+    referenced by multiple backups. Unreferenced objects are then removed in
+    batches. If dry_run is set, nothing is removed but reported only.
+
+    Trees are expanded level by level; trees shared by multiple backups
+    are only fetched once. Manifests, trees and chunk lists are fetched and
+    unused objects deleted by a pool of workers using the batch operations
+    of the backend. The generation of the repository is changed before any
+    object is removed, see generation().
+
+    Returns a list of removed object names. """
+    needed = set()
+    removed = []
+    removed_bytes = 0
+    lists = []
+    trees = []
+
+    def mark(meta_data):
         for _, entry in meta_data.items():
-            content = entry.get('c', '')
-            if content.startswith('c'):
-                needed_chunks.append(content)
+            content = entry.get('c')
+            if not content or content in needed:
+                continue
+            needed.add(content)
             if content.startswith('o'):
-                needed_objs.append(content)
-                list_of_chunks = backend.get(content)
-                for chunk in list_of_chunks.split(';'):
-                    needed_chunks.append("c-" + chunk)
-    removed = []
+                lists.append(content)
+            elif content.startswith('t'):
+                trees.append(content)
 
-    all_chunks = backend.list("c-*")
-    for chunk in all_chunks:
-        chunk_name = os.path.basename(chunk)
-        if chunk_name not in needed_chunks:
-            backend.delete(chunk_name)
-            removed.append(chunk)
-            logging.info("Removed chunk %s" % chunk)
-
-    all_objs = backend.list("o-*")
-    for obj in all_objs:
-        obj_name = os.path.basename(obj)
-        if obj_name not in needed_objs:
-            backend.delete(obj_name)
-            removed.append(obj)
-            logging.info("Removed obj %s" % obj)
+    pool = utils.WorkerPool(workers)
+    try:
+        with stats.timer("mark"):
+            backups = (os.path.basename(obj) for obj in backend.list("b-*"))
+            for _, data in backend.get_many(backups, pool):
+                meta_data = manifest.load(data, backend.get)
+                if isinstance(meta_data, manifest.Tree):
+                    if meta_data.name not in needed:
+                        needed.add(meta_data.name)
+                        trees.append(meta_data.name)
+                else:
+                    mark(meta_data)
+            while trees:
+                batch, trees = trees, []
+                for _, data in backend.get_many(batch, pool):
+                    mark(manifest.Manifest(data))
+            for _, data in backend.get_many(lists, pool):
+                needed.update("c-" + checksum
+                              for checksum, _ in parse_chunk_list(data)
+                              if checksum != ZERO_CHUNK)
+        stats.add("needed_objects", len(needed))
+
+        with stats.timer("sweep"):
+            # Files caches of backups are invalidated first
+            if not dry_run:
+                markers = generation(backend)
+                backend.put("g-%s" % os.urandom(16).encode("hex"), "")
+                backend.delete_many(markers, pool)
+            # Chunks are removed last; chunks of existing lists are used
+            # without checking them, see read_hinted_chunks()
+            for prefix in ["t-*", "o-*", "c-*"]:
+                names = (os.path.basename(obj) for obj in backend.list(prefix))
+                unused = (name for name in names if name not in needed)
+                for batch in utils.batches(unused, GC_BATCH_SIZE):
+                    removed_bytes += sum(
+                        size for _, size in backend.size_many(batch, pool))
+                    if not dry_run:
+                        backend.delete_many(batch, pool)
+                    removed.extend(batch)
+                    stats.add("removed_objects", len(batch))
+                    logging.info("%s %s objects" % (
+                        "Found unused" if dry_run else "Removed",
+                        len(removed)))
+    finally:
+        pool.close()
+
+    logging.info("%s %s objects with a total size of %s bytes" % (
+        "Would remove" if dry_run else "Removed", len(removed),
+        removed_bytes))
+
+    # Indexes of local backends are rebuilt from the objects left on disk;
+    # this also drops objects deleted by other means
+    if not dry_run and hasattr(backend, "rebuild_index"):
+        indexed = backend.rebuild_index()
+        logging.info("Rebuilt index of %s objects" % indexed)
+
+    # Space of chunks in pack files is only freed by rewriting the packs
+    if not dry_run and hasattr(backend, "repack"):
+        freed = backend.repack()
+        logging.info("Repacked chunks, freed %s bytes" % freed)
     return removed
 
 
 def list_backups(backend, path, backup_id=None):
-    backups = backend.list(prefix="b-*")
+    backups = sorted(backend.list(prefix="b-*"))
     for backup in backups:
         backup_name = os.path.basename(backup)
         if backup_id is None:
             print backup_name
         else:
             if backup_name == backup_id:
-                om = backend.get(backup_id)
-                try:
-                    old_meta_data = json.loads(om)
-                except ValueError:
-                    pass
-                for name in sorted(old_meta_data):
-                    meta = old_meta_data.get(name)
+                old_meta_data = load_manifest(backend, backup_id)
+                for name, meta in old_meta_data.items():
                     datestring = time.strftime(
                         "%d %b %Y %H:%M:%S", time.localtime(meta.get('m')))
                     size = utils.sizeof_fmt(meta.get('s'))
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+"""
+Copyright 2014 Christian Schwede.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+import bz2
+import zlib
+
+from safebox import stats
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Objects written with a codec start with this header, followed by a single
+# byte identifying the codec. Objects without header are bz2 compressed.
+MAGIC = "SBX"
+
+# Data is stored uncompressed if compressing a sample of this size does not
+# save at least MIN_SAVING of its size
+SAMPLE_SIZE = 64 * 1024
+MIN_SAVING = 0.05
+
+NONE, ZLIB, BZ2, LZMA = "0", "1", "2", "3"
+
+DEFAULT_LEVELS = {ZLIB: 6, BZ2: 9, LZMA: 6}
+
+
+def _compressor(codec_id, level):
+    if codec_id == ZLIB:
+        return lambda data: zlib.compress(data, level)
+    if codec_id == BZ2:
+        return lambda data: bz2.compress(data, level)
+    if codec_id == LZMA:
+        return lambda data: lzma.compress(data, preset=level)
+    return lambda data: data
+
+
+DECOMPRESSORS = {
+    NONE: lambda data: data,
+    ZLIB: zlib.decompress,
+    BZ2: bz2.decompress,
+    LZMA: lambda data: lzma.decompress(data),
+}
+
+
+class Codec(object):
+    """ Compresses objects and prepends a header naming the codec used.
+
+    Codecs are given as "none", "zlib", "bz2" or "lzma", optionally followed
+    by a compression level, for example "zlib:1". """
+    def __init__(self, spec="bz2"):
+        self.spec = spec
+        name, _, level = spec.partition(":")
+        codec_ids = {"none": NONE, "zlib": ZLIB, "bz2": BZ2, "lzma": LZMA}
+        if name not in codec_ids:
+            raise ValueError("Unknown codec %s" % name)
+        self.codec_id = codec_ids[name]
+        if self.codec_id == LZMA and lzma is None:
+            raise ValueError("lzma is not available, install backports.lzma")
+        try:
+            level = int(level) if level else DEFAULT_LEVELS.get(self.codec_id)
+        except ValueError:
+            raise ValueError("Invalid compression level %s" % level)
+        self.compressor = _compressor(self.codec_id, level)
+
+    def compress(self, data):
+        """ Returns compressed data including header
+
+        Data is stored raw if a sample of it can't be compressed well, for
+        example chunks of already compressed media files. """
+        if self.codec_id == NONE:
+            return MAGIC + NONE + data
+        with stats.timer("compress"):
+            sample = data[:SAMPLE_SIZE]
+            compressed = self.compressor(sample)
+            if len(compressed) > len(sample) * (1 - MIN_SAVING):
+                return MAGIC + NONE + data
+            if len(sample) < len(data):
+                compressed = self.compressor(data)
+            return MAGIC + self.codec_id + compressed
+
+
+def decompress(data):
+    """ Returns decompressed data of an object written by any codec """
+    decompressor, payload = bz2.decompress, data
+    if data.startswith(MAGIC):
+        codec_id = data[len(MAGIC)]
+        try:
+            decompressor = DECOMPRESSORS[codec_id]
+        except KeyError:
+            raise ValueError("Unknown codec id %s" % codec_id)
+        payload = data[len(MAGIC) + 1:]
+    with stats.timer("decompress"):
+        return decompressor(payload)
@@ -0,0 +1,203 @@
+#!/usr/bin/python
+"""
+Copyright 2014 Christian Schwede.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+import bisect
+import errno
+import os
+import stat as stat_module
+
+from safebox import common, manifest, utils
+
+try:
+    import fuse
+except ImportError:
+    fuse = None
+
+# Chunk offsets of this many files are kept in memory
+INDEX_CACHE_SIZE = 1024
+
+
+class BackupFS(object):
+    """ Read-only access to the files and directories of a single backup.
+
+    Paths are relative to the backed up directory; leading and trailing
+    slashes are ignored. Reading a file only fetches the chunks containing
+    the requested range, decompressed chunks are kept in a cache of up to
+    cache_size bytes. """
+    def __init__(self, backend, backup_id,
+                 cache_size=common.RESTORE_CACHE_SIZE):
+        self.backend = backend
+        self.manifest = common.load_manifest(backend, backup_id)
+        self.cache = utils.LRUCache(cache_size)
+        self.indexes = {}
+
+    def _lookup(self, path):
+        """ Returns the manifest path and entry of path """
+        path = manifest.encode_path(path).strip("/")
+        if not path:
+            return "", {'s': 0, 'u': os.getuid(), 'g': os.getgid(), 'm': 0,
+                        'p': stat_module.S_IFDIR | 0755}
+        entry = self.manifest.get(path)
+        if entry is None:
+            path += "/"
+            entry = self.manifest.get(path)
+        if entry is None:
+            raise OSError(errno.ENOENT, "No such file or directory", path)
+        return path, entry
+
+    def stat(self, path):
+        """ Returns the entry of a file or directory.
+
+        Entries are dictionaries of size, uid, gid, mtime and mode, see
+        utils.stat2dict(). """
+        return self._lookup(path)[1]
+
+    def listdir(self, path=""):
+        """ Returns the sorted names of the entries of a directory """
+        path, entry = self._lookup(path)
+        if not stat_module.S_ISDIR(entry['p']):
+            raise OSError(errno.ENOTDIR, "Not a directory", path)
+        return [name.rstrip("/") for name, _ in self.manifest.children(path)]
+
+    def open(self, path):
+        """ Returns a File to read a regular file """
+        path, entry = self._lookup(path)
+        if not stat_module.S_ISREG(entry['p']):
+            raise IOError(errno.EISDIR, "Not a regular file", path)
+        return File(self, entry)
+
+    def read(self, path, offset, length):
+        """ Returns up to length bytes of a file, starting at offset """
+        return self.open(path).pread(offset, length)
+
+    def chunk(self, name):
+        """ Returns the decompressed data of a chunk """
+        data = self.cache.get(name)
+        if data is None:
+            data = self.backend.get(name)
+            self.cache.put(name, data)
+        return data
+
+    def chunk_index(self, entry):
+        """ Returns the chunk names and start offsets of a file.
+
+        Names are None for zero-filled extents. The start offsets are
+        followed by the size of the file. """
+        content = entry.get('c')
+        if not content:
+            return [], [0]
+        index = self.indexes.get(content)
+        if index is None:
+            names = []
+            offsets = [0]
+            for name, size in common.file_chunks(self.backend, entry):
+                if size is None:  # written by an earlier version
+                    size = len(self.chunk(name))
+                names.append(name)
+                offsets.append(offsets[-1] + size)
+            if len(self.indexes) >= INDEX_CACHE_SIZE:
+                self.indexes.clear()
+            index = self.indexes[content] = (names, offsets)
+        return index
+
+
+class File(object):
+    """ A regular file of a backup opened for reading """
+    def __init__(self, fs, entry):
+        self.fs = fs
+        self.names, self.offsets = fs.chunk_index(entry)
+        self.size = self.offsets[-1]
+        self.position = 0
+
+    def pread(self, offset, length):
+        """ Returns up to length bytes starting at offset """
+        end = min(offset + length, self.size)
+        result = []
+        chunk = bisect.bisect_right(self.offsets, offset) - 1
+        while offset < end:
+            start = self.offsets[chunk]
+            stop = min(self.offsets[chunk + 1], end)
+            name = self.names[chunk]
+            if name is None:
+                result.append("\0" * (stop - offset))
+            else:
+                result.append(
+                    self.fs.chunk(name)[offset - start:stop - start])
+            offset = stop
+            chunk += 1
+        return "".join(result)
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size
+        data = self.pread(self.position, size)
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def mount(backup_fs, mountpoint, foreground=True):
+    """ Mounts a BackupFS read-only at mountpoint using fusepy """
+    if fuse is None:
+        raise ImportError("Mounting a backup requires fusepy")
+
+    class Operations(fuse.Operations):
+        def __call__(self, op, *args):
+            try:
+                return super(Operations, self).__call__(op, *args)
+            except (IOError, OSError) as e:
+                raise fuse.FuseOSError(e.errno or errno.EIO)
+
+        def getattr(self, path, fh=None):
+            entry = backup_fs.stat(path)
+            return {'st_mode': entry['p'], 'st_size': entry['s'],
+                    'st_uid': entry['u'], 'st_gid': entry['g'],
+                    'st_mtime': entry['m'], 'st_ctime': entry['m'],
+                    'st_atime': entry['m'], 'st_nlink': 1}
+
+        def readdir(self, path, fh):
+            return ['.', '..'] + backup_fs.listdir(path)
+
+        def open(self, path, flags):
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                raise fuse.FuseOSError(errno.EROFS)
+            backup_fs.open(path)
+            return 0
+
+        def read(self, path, size, offset, fh):
+            return backup_fs.read(path, offset, size)
+
+    fuse.FUSE(Operations(), mountpoint, foreground=foreground, ro=True,
+              nothreads=True)
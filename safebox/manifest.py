@@ -0,0 +1,359 @@
+#!/usr/bin/python
+"""
+Copyright 2014 Christian Schwede.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+import bisect
+import hashlib
+import json
+import struct
+from cStringIO import StringIO
+
+# Binary manifests start with MAGIC followed by a version byte. Manifests
+# written by earlier versions are JSON objects.
+MAGIC = "SBM"
+VERSION = "1"
+
+# Records are sorted by path and grouped into blocks of about BLOCK_SIZE
+# bytes. An index listing the first path and offset of each block and a
+# footer pointing to the index follow the last block.
+BLOCK_SIZE = 64 * 1024
+
+# Backups stored as tree objects consist of TREE_MAGIC followed by the name
+# of the root tree. Every tree is a binary manifest of the entries of one
+# directory, see TreeWriter.
+TREE_MAGIC = "SBT1"
+TREE_CACHE_SIZE = 64
+
+PATH = struct.Struct(">H")
+STAT = struct.Struct(">QIIdIB")
+BLOCK = struct.Struct(">HQ")
+FOOTER = struct.Struct(">QI")
+
+
+def encode_path(path):
+    if isinstance(path, unicode):
+        return path.encode("utf-8")
+    return path
+
+
+def valid_path(path):
+    """ Returns True if path can be stored, paths are read as UTF-8 """
+    try:
+        encode_path(path).decode("utf-8")
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+class Writer(object):
+    """ Writes a binary manifest from entries added in sorted path order """
+    def __init__(self):
+        self.data = StringIO()
+        self.data.write(MAGIC + VERSION)
+        self.blocks = []
+        self.block_start = None
+        self.last_path = None
+
+    def add(self, path, entry):
+        path = encode_path(path)
+        if not valid_path(path):
+            raise ValueError("Path %r is not valid UTF-8" % path)
+        if self.last_path is not None and path <= self.last_path:
+            raise ValueError("Entries must be added in sorted order")
+        self.last_path = path
+        offset = self.data.tell()
+        if self.block_start is None or \
+                offset - self.block_start >= BLOCK_SIZE:
+            self.blocks.append((path, offset))
+            self.block_start = offset
+        content = entry.get('c', '')
+        self.data.write(PATH.pack(len(path)))
+        self.data.write(path)
+        self.data.write(STAT.pack(entry['s'], entry['u'], entry['g'],
+                                  entry['m'], entry['p'], len(content)))
+        self.data.write(content)
+
+    def getvalue(self):
+        """ Returns the manifest including block index and footer """
+        index_offset = self.data.tell()
+        for path, offset in self.blocks:
+            self.data.write(BLOCK.pack(len(path), offset))
+            self.data.write(path)
+        self.data.write(FOOTER.pack(index_offset, len(self.blocks)))
+        return self.data.getvalue()
+
+
+def dumps(files):
+    """ Returns a binary manifest of a dict of paths and their entries """
+    writer = Writer()
+    for path, entry in sorted((encode_path(path), entry)
+                              for path, entry in files.iteritems()):
+        writer.add(path, entry)
+    return writer.getvalue()
+
+
+class Manifest(object):
+    """ Read-only access to the entries of a manifest.
+
+    Entries of binary manifests are decoded while iterating, and looking up
+    a single path only decodes the block containing it. JSON manifests
+    written by earlier versions are supported as well. Paths are returned as
+    unicode strings. """
+    def __init__(self, data):
+        self.data = data
+        self.json = None
+        self.block_paths = []
+        self.block_offsets = []
+        self.cached_block = (None, {})
+        if not data.startswith(MAGIC):
+            self.json = json.loads(data)
+            return
+        if data[len(MAGIC)] != VERSION:
+            raise ValueError("Unsupported manifest version %s" %
+                             data[len(MAGIC)])
+        index_offset, count = FOOTER.unpack_from(data, len(data) - FOOTER.size)
+        offset = index_offset
+        for _ in range(count):
+            length, block_offset = BLOCK.unpack_from(data, offset)
+            offset += BLOCK.size
+            self.block_paths.append(data[offset:offset + length])
+            self.block_offsets.append(block_offset)
+            offset += length
+        self.block_offsets.append(index_offset)
+
+    def _records(self, start, end):
+        data = self.data
+        offset = start
+        while offset < end:
+            length, = PATH.unpack_from(data, offset)
+            offset += PATH.size
+            path = data[offset:offset + length]
+            offset += length
+            s, u, g, m, p, length = STAT.unpack_from(data, offset)
+            offset += STAT.size
+            entry = {'s': s, 'u': u, 'g': g, 'm': m, 'p': p}
+            if length:
+                entry['c'] = data[offset:offset + length]
+                offset += length
+            yield path, entry
+
+    def _items(self):
+        if self.json is not None:
+            for path in sorted(self.json):
+                yield path, self.json[path]
+            return
+        for path, entry in self._records(self.block_offsets[0],
+                                         self.block_offsets[-1]):
+            yield path.decode("utf-8"), entry
+
+    def items(self, descend=None):
+        """ Yields (path, entry) tuples sorted by path
+
+        If descend is given, the entries below a directory are skipped
+        unless descend(path, entry) returns True for the directory. """
+        skipped = None
+        for path, entry in self._items():
+            if skipped is not None:
+                if path.startswith(skipped):
+                    continue
+                skipped = None
+            yield path, entry
+            if descend and path.endswith("/") and not descend(path, entry):
+                skipped = path
+
+    def __iter__(self):
+        for path, _ in self.items():
+            yield path
+
+    def get(self, path, default=None):
+        """ Returns the entry of a single path """
+        if self.json is not None:
+            if not isinstance(path, unicode):
+                path = path.decode("utf-8")
+            return self.json.get(path, default)
+        path = encode_path(path)
+        block = bisect.bisect_right(self.block_paths, path) - 1
+        if block < 0:
+            return default
+        # Lookups in path order are likely to hit the same block again
+        if self.cached_block[0] != block:
+            self.cached_block = (block, dict(self._records(
+                self.block_offsets[block], self.block_offsets[block + 1])))
+        return self.cached_block[1].get(path, default)
+
+    def children(self, prefix=""):
+        """ Yields (name, entry) tuples of the direct children of a directory
+
+        prefix is the path of the directory including its trailing slash, or
+        an empty string for the top level directory. Names of directories
+        end with a slash. """
+        prefix = encode_path(prefix)
+        if self.json is not None:
+            items = sorted((path.encode("utf-8"), entry)
+                           for path, entry in self.json.iteritems())
+        else:
+            block = max(bisect.bisect_right(self.block_paths, prefix) - 1, 0)
+            items = self._records(self.block_offsets[block],
+                                  self.block_offsets[-1])
+        for path, entry in items:
+            if not path.startswith(prefix):
+                if path > prefix:
+                    break
+                continue
+            name = path[len(prefix):]
+            if name and "/" not in name[:-1]:
+                yield name.decode("utf-8"), entry
+
+
+class TreeWriter(object):
+    """ Writes one tree object per directory from entries added in sorted
+    path order.
+
+    Trees list the names of the entries of a directory; the entry of a
+    subdirectory names its tree as content. A tree is named after the hash
+    of its data, thus unchanged directories result in the same tree objects
+    as before. store(name, data) is called once all entries of a tree are
+    added, unless the tree is the same as in the previous backup; previous
+    is the name of the root tree of the previous backup. If trees is given,
+    trees(path, name) is called for every tree, whether stored or not; the
+    root tree has an empty path. """
+    def __init__(self, store, previous=None, trees=None):
+        self.store = store
+        self.trees = trees
+        self.stack = [("", None, Writer(), previous)]
+
+    def _finish(self):
+        path, entry, writer, previous = self.stack.pop()
+        data = writer.getvalue()
+        name = "t-%s" % hashlib.sha256(data).hexdigest()
+        if name != previous:
+            self.store(name, data)
+        if self.trees:
+            self.trees(path, name)
+        return path, entry, name
+
+    def _close(self):
+        path, entry, name = self._finish()
+        parent = self.stack[-1][0]
+        self.stack[-1][2].add(path[len(parent):], dict(entry, c=name))
+
+    def add(self, path, entry, previous=None):
+        """ Adds an entry; previous is the name of the tree of a directory
+        in the previous backup """
+        path = encode_path(path)
+        while not path.startswith(self.stack[-1][0]):
+            self._close()
+        if path.endswith("/"):
+            self.stack.append((path, entry, Writer(), previous))
+        else:
+            parent = self.stack[-1][0]
+            self.stack[-1][2].add(path[len(parent):], entry)
+
+    def getvalue(self):
+        """ Stores all remaining trees and returns the backup data pointing
+        to the root tree """
+        while len(self.stack) > 1:
+            self._close()
+        _, _, name = self._finish()
+        return TREE_MAGIC + name
+
+
+class Tree(object):
+    """ Read-only access to the entries of a backup stored as tree objects.
+
+    Provides the same methods as Manifest. Trees are fetched using
+    fetch(name) when they are needed; entries of directories name their tree
+    as content. If fetch_many(names) is given, it must yield (name, data)
+    tuples in the order of names; items() uses it to read the trees of all
+    subdirectories of a directory ahead. """
+    def __init__(self, fetch, name, fetch_many=None):
+        self.fetch = fetch
+        self.name = name
+        self.cached_trees = {}
+        self.fetch_many = fetch_many or (
+            lambda names: ((name, fetch(name)) for name in names))
+
+    def tree(self, name):
+        """ Returns the Manifest of a single tree """
+        tree = self.cached_trees.get(name)
+        if tree is None:
+            if len(self.cached_trees) >= TREE_CACHE_SIZE:
+                self.cached_trees.clear()
+            tree = self.cached_trees[name] = Manifest(self.fetch(name))
+        return tree
+
+    def _items(self, prefix, data, descend):
+        entries = [(prefix + path, entry)
+                   for path, entry in Manifest(data).items()]
+        expanded = [path.endswith("/") and
+                    (not descend or descend(path, entry))
+                    for path, entry in entries]
+        subtrees = self.fetch_many([
+            entry['c'] for (_, entry), expand in zip(entries, expanded)
+            if expand])
+        for (path, entry), expand in zip(entries, expanded):
+            yield path, entry
+            if expand:
+                _, subtree = next(subtrees)
+                for item in self._items(path, subtree, descend):
+                    yield item
+
+    def items(self, descend=None):
+        """ Yields (path, entry) tuples sorted by path
+
+        Trees of directories are only fetched if descend(path, entry) returns
+        True for them, or if descend is not given. """
+        return self._items(u"", self.fetch(self.name), descend)
+
+    def __iter__(self):
+        for path, _ in self.items():
+            yield path
+
+    def children(self, prefix=""):
+        """ Yields (name, entry) tuples of the direct children of a directory,
+        see Manifest.children() """
+        name = self.name
+        if prefix:
+            entry = self.get(prefix)
+            if not entry or not entry.get('c', '').startswith('t-'):
+                return iter([])
+            name = entry['c']
+        return self.tree(name).items()
+
+    def get(self, path, default=None):
+        """ Returns the entry of a single path """
+        path = encode_path(path)
+        tree = self.tree(self.name)
+        start = 0
+        while True:
+            end = path.find("/", start) + 1
+            if not end or end == len(path):
+                return tree.get(path[start:], default)
+            entry = tree.get(path[start:end])
+            if not entry or not entry.get('c', '').startswith('t-'):
+                return default
+            tree = self.tree(entry['c'])
+            start = end
+
+
+def load(data, fetch, fetch_many=None):
+    """ Returns the manifest of a backup, either a Manifest or a Tree.
+
+    fetch(name) must return the data of a tree object, see Tree for
+    fetch_many. """
+    if data.startswith(TREE_MAGIC):
+        return Tree(fetch, data[len(TREE_MAGIC):], fetch_many)
+    return Manifest(data)
@@ -2,11 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import json
 import logging
 import os
 import sys
 
-from safebox import backends, common
+from safebox import backends, benchmark, common, fs, stats, utils
 
 LOG_LEVEL = logging.INFO
 LOG_FORMAT = "%(levelname)s %(threadName)s %(asctime)s %(message)s"
@@ -21,15 +22,51 @@ def main(argv=sys.argv):
     parser.add_argument('--hmac-key', default="", help='HMAC Key')
     parser.add_argument(
         '--tag', default="default", help='Tag to use for this backup')
+    parser.add_argument(
+        '--packs', action="store_true",
+        help='Store chunks in pack files instead of single files')
+    parser.add_argument(
+        '--os-auth-token', default=os.environ.get('OS_AUTH_TOKEN'),
+        help='Swift auth token if path is a container URL, defaults to '
+             'env[OS_AUTH_TOKEN]')
+    parser.add_argument(
+        '--progress', action="store_true",
+        help='Show throughput and progress while running')
+    parser.add_argument(
+        '--stats-file', action="store", type=str,
+        help='Write counters and timings of all phases as JSON to this file')
 
     subparsers = parser.add_subparsers(dest="subparsers")
 
     parser_backup = subparsers.add_parser(
         'backup', help='Create new backup')
     parser_backup.add_argument(
-        'src', action="store", type=str, help='Source path')
+        'src', action="store", type=str, nargs="*",
+        help='Source paths; multiple sources are stored as top-level '
+             'files or directories named after their basenames')
     parser_backup.add_argument(
         'path', action="store", type=str, help='Destination path')
+    parser_backup.add_argument(
+        '--files-from', action="store", type=str,
+        help='File listing additional source paths, one per line')
+    parser_backup.add_argument(
+        '--workers', action="store", type=int, default=common.DEFAULT_WORKERS,
+        help='Number of threads hashing and storing chunks')
+    parser_backup.add_argument(
+        '--processes', action="store", type=int, default=0,
+        help='Number of processes chunking, hashing and storing whole files; '
+             'uses threads only by default')
+    parser_backup.add_argument(
+        '--codec', action="store", type=str, default="bz2",
+        help='Compression of new objects: none, zlib, bz2 or lzma, '
+             'optionally with a level like zlib:1')
+    parser_backup.add_argument(
+        '--files-cache', action="store", type=str,
+        help='Local cache of unchanged files, defaults to a file in '
+             '~/.cache/safebox')
+    parser_backup.add_argument(
+        '--no-files-cache', action="store_true",
+        help='Detect unchanged files using the latest backup only')
 
     parser_restore = subparsers.add_parser(
         'restore', help='Restore from backup')
@@ -39,11 +76,36 @@ def main(argv=sys.argv):
         'dst', action="store", type=str, help='Destination path')
     parser_restore.add_argument(
         'backup_id', action="store", type=str, help='Backup ID')
+    parser_restore.add_argument(
+        '--workers', action="store", type=int, default=common.DEFAULT_WORKERS,
+        help='Number of threads fetching chunks')
+    parser_restore.add_argument(
+        '--cache-size', action="store", type=int,
+        default=common.RESTORE_CACHE_SIZE / 2 ** 20,
+        help='Memory for decompressed chunks needed again later in MB, '
+             'further chunks are kept in a temporary file')
+    parser_restore.add_argument(
+        '--include', action="append", type=str,
+        help='Restore only paths matching this glob pattern, may be given '
+             'multiple times')
+    parser_restore.add_argument(
+        '--exclude', action="append", type=str,
+        help='Skip paths matching this glob pattern, may be given multiple '
+             'times')
+    parser_restore.add_argument(
+        '--incremental', action="store_true",
+        help='Skip unchanged files in dst and reuse data of existing files')
 
-    parser_restore = subparsers.add_parser(
+    parser_gc = subparsers.add_parser(
         'gc', help='Garbage collect')
-    parser_restore.add_argument(
+    parser_gc.add_argument(
         'path', action="store", type=str, help='Backup path')
+    parser_gc.add_argument(
+        '--dry-run', action="store_true",
+        help='Only report unused objects, do not remove them')
+    parser_gc.add_argument(
+        '--workers', action="store", type=int, default=common.DEFAULT_WORKERS,
+        help='Number of threads fetching and deleting objects')
 
     parser_list = subparsers.add_parser(
         'list', help='List backups')
@@ -52,16 +114,132 @@ def main(argv=sys.argv):
     parser_list.add_argument(
         '--backup-id', action="store", type=str, help='Backup ID')
 
+    parser_mount = subparsers.add_parser(
+        'mount', help='Mount a backup read-only, requires fusepy')
+    parser_mount.add_argument(
+        'path', action="store", type=str, help='Backup path')
+    parser_mount.add_argument(
+        'backup_id', action="store", type=str, help='Backup ID')
+    parser_mount.add_argument(
+        'mountpoint', action="store", type=str, help='Mount point')
+    parser_mount.add_argument(
+        '--cache-size', action="store", type=int,
+        default=common.RESTORE_CACHE_SIZE / 2 ** 20,
+        help='Cache size for decompressed chunks in MB')
+
+    parser_benchmark = subparsers.add_parser(
+        'benchmark', help='Benchmark backup, restore and gc on synthetic data')
+    parser_benchmark.add_argument(
+        '--scenario', action="append", type=str,
+        choices=sorted(benchmark.SCENARIOS),
+        help='Scenario to run, may be given multiple times. Defaults to all')
+    parser_benchmark.add_argument(
+        '--scale', action="store", type=float, default=1.0,
+        help='Factor for the size of the generated data')
+    parser_benchmark.add_argument(
+        '--workers', action="store", type=int, default=common.DEFAULT_WORKERS,
+        help='Number of worker threads')
+    parser_benchmark.add_argument(
+        '--seed', action="store", type=int, default=0,
+        help='Seed of the generated data')
+    parser_benchmark.add_argument(
+        '--workdir', action="store", type=str,
+        help='Directory for the generated data, defaults to a temporary one')
+    parser_benchmark.add_argument(
+        '--output', action="store", type=str,
+        help='Write results as JSON to this file instead of stdout')
+    parser_benchmark.add_argument(
+        '--compare', action="store", type=str,
+        help='Compare with results of an earlier run and exit with an error '
+             'on regressions')
+    parser_benchmark.add_argument(
+        '--threshold', action="store", type=float,
+        default=benchmark.DEFAULT_THRESHOLD,
+        help='Allowed increase of metrics when comparing, as a fraction')
+
     args = parser.parse_args(argv[1:])
 
-    path = os.path.expanduser(args.path)
-    backend = backends.LocalStorage(path)
+    if args.subparsers == "benchmark":
+        results = benchmark.run(args.scenario, args.scale, args.workers,
+                                args.seed, args.workdir)
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, "w") as outfile:
+                outfile.write(output + "\n")
+        else:
+            print output
+        if args.compare:
+            with open(args.compare) as infile:
+                regressions = benchmark.compare(
+                    json.load(infile), results, args.threshold)
+            for regression in regressions:
+                logging.error("Regression in %s %s: %s %s -> %s" % regression)
+            if regressions:
+                sys.exit(1)
+        return
 
+    path = os.path.expanduser(args.path)
+    backend_options = {}
     if args.subparsers == "backup":
-        common.backup(backend, args.src, args.tag)
-    if args.subparsers == "restore":
-        common.restore(backend, args.dst, args.backup_id)
-    if args.subparsers == "gc":
-        common.gc(backend)
+        backend_options['codec'] = args.codec
+        sources = list(args.src)
+        if args.files_from:
+            with open(args.files_from) as infile:
+                sources.extend(line.rstrip("\n") for line in infile
+                               if line.strip())
+        if not sources:
+            parser.error("no source paths given")
+        if len(sources) == 1:
+            sources = sources[0]
+        else:
+            try:
+                common.source_names(sources)
+            except ValueError as e:
+                parser.error(str(e))
+    storage = backends.LocalStorage
+    if path.startswith(("http://", "https://")):
+        storage = backends.SwiftStorage
+        backend_options['token'] = args.os_auth_token
+    elif args.packs or os.path.isdir(os.path.join(path, "p")):
+        storage = backends.PackedStorage
+    try:
+        backend = storage(path, **backend_options)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.subparsers == "backup" and args.processes and \
+            not backend.process_safe:
+        parser.error("--processes is not supported by %s" % storage.__name__)
+
+    stats.reset()
+    progress = stats.Progress() if args.progress else None
+    if progress:
+        progress.start()
+    try:
+        if args.subparsers == "backup":
+            files_cache = args.files_cache or \
+                utils.files_cache_name(path, sources)
+            if args.no_files_cache:
+                files_cache = None
+            common.backup(backend, sources, args.tag, workers=args.workers,
+                          files_cache=files_cache, processes=args.processes)
+        if args.subparsers == "restore":
+            common.restore(
+                backend, args.dst, args.backup_id, workers=args.workers,
+                cache_size=args.cache_size * 2 ** 20, include=args.include,
+                exclude=args.exclude, incremental=args.incremental)
+        if args.subparsers == "gc":
+            common.gc(backend, dry_run=args.dry_run, workers=args.workers)
+        if args.subparsers == "mount":
+            if fs.fuse is None:
+                parser.error("mounting a backup requires fusepy")
+            fs.mount(fs.BackupFS(backend, args.backup_id,
+                                 cache_size=args.cache_size * 2 ** 20),
+                     args.mountpoint)
+    finally:
+        backend.close()
+        if progress:
+            progress.stop()
+        if args.stats_file:
+            stats.save(args.stats_file)
     if args.subparsers == "list":
         common.list_backups(backend, args.path, args.backup_id)
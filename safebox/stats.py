@@ -0,0 +1,159 @@
+#!/usr/bin/python
+"""
+Copyright 2014 Christian Schwede.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+import collections
+import contextlib
+import json
+import sys
+import threading
+import time
+
+
+class Stats(object):
+    """ Thread-safe counters and timers of the phases of a command.
+
+    Timers sum up the time spent in a phase by all threads, thus they may
+    exceed the elapsed time if workers run in parallel. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = collections.defaultdict(int)
+            self.timers = collections.defaultdict(float)
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.timers[name] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """ Context manager adding the time spent in its block to a timer """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def timed_iter(self, name, iterable):
+        """ Yields the items of iterable, adding the time spent to get each
+        of them to a timer """
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            finally:
+                self.add_time(name, time.time() - start)
+            yield item
+
+    def merge(self, snapshot):
+        """ Adds the counters and timers of a snapshot, for example one
+        taken in another process """
+        with self.lock:
+            for name, value in snapshot['counters'].items():
+                self.counters[name] += value
+            for name, seconds in snapshot['timers'].items():
+                self.timers[name] += seconds
+
+    def snapshot(self):
+        """ Returns elapsed time, counters and timers as a dict """
+        with self.lock:
+            return {
+                'elapsed': round(time.time() - self.started, 4),
+                'counters': dict(self.counters),
+                'timers': dict((name, round(seconds, 4))
+                               for name, seconds in self.timers.items()),
+            }
+
+    def save(self, filename):
+        """ Writes a snapshot to a JSON file """
+        with open(filename, "w") as outfile:
+            json.dump(self.snapshot(), outfile, indent=2, sort_keys=True)
+            outfile.write("\n")
+
+
+# Statistics of the current command, used by all modules
+current = Stats()
+reset = current.reset
+add = current.add
+timer = current.timer
+timed_iter = current.timed_iter
+merge = current.merge
+snapshot = current.snapshot
+save = current.save
+
+
+def format_progress(snapshot, counter="bytes", total_counter="total_bytes"):
+    """ Returns a single line of progress including throughput and ETA """
+    counters = snapshot['counters']
+    elapsed = max(snapshot['elapsed'], 0.001)
+    done = counters.get(counter, 0)
+    rate = done / elapsed
+    line = "%d files, %.1f MB, %.1f MB/s" % (
+        counters.get('files', 0), done / 2.0 ** 20, rate / 2 ** 20)
+    total = counters.get(total_counter)
+    if total:
+        line += ", %.1f%%" % (100.0 * min(done, total) / total)
+        if rate:
+            line += ", ETA %ds" % (max(total - done, 0) / rate)
+    return line
+
+
+class Progress(object):
+    """ Thread writing the progress of the current command to a stream.
+
+    Usable as a context manager; the line is rewritten every interval
+    seconds. """
+    def __init__(self, stats=current, interval=1.0, stream=None):
+        self.stats = stats
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def write(self):
+        self.stream.write("\r" + format_progress(self.stats.snapshot()))
+        self.stream.flush()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="Progress")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+        self.stream.write("\n")
@@ -17,7 +17,15 @@ limitations under the License.
 """
 import collections
 import hashlib
+import marshal
+import multiprocessing
 import os
+import Queue
+import sys
+import tempfile
+import threading
+
+from stat import S_ISDIR
 
 
 def sha256_string(string, secret=""):
@@ -37,29 +45,295 @@ def sha256_file(filename, block_size=2 ** 20):
         return None
 
 
+def iter_chunks(infile, sizes):
+    """ Yields (offset, data) for consecutive chunks of given sizes in infile.
+
+    Stops after a short chunk if the file was truncated while reading it.
+    The file is not mapped into memory, because accessing a mapping of a
+    truncated file kills the process with SIGBUS. """
+    offset = 0
+    for size in sizes:
+        data = infile.read(size)
+        yield offset, data
+        offset += len(data)
+        if len(data) < size:
+            break
+
+
+def batches(iterable, size):
+    """ Yields lists of up to size items taken from iterable. """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class LRUCache(object):
+    """ Least recently used cache, limited by the total size of its values.
+
+    Values must be strings; values larger than max_bytes are not cached. """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the cached value or None """
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, old = self.items.popitem(last=False)
+                self.size -= len(old)
+
+
+class SpillCache(object):
+    """ Cache keeping values until they are removed with pop().
+
+    Values are kept in memory up to a total size of max_bytes, further values
+    are written to a temporary file. Values must be strings. """
+    def __init__(self, max_bytes, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.size = 0
+        self.items = {}
+        self.spilled = {}
+        self.spill_file = None
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.items or key in self.spilled
+
+    def get(self, key):
+        """ Returns the cached value or None """
+        with self.lock:
+            value = self.items.get(key)
+            if value is None and key in self.spilled:
+                offset, length = self.spilled[key]
+                self.spill_file.seek(offset)
+                value = self.spill_file.read(length)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.items or key in self.spilled:
+                return
+            if self.size + len(value) <= self.max_bytes:
+                self.items[key] = value
+                self.size += len(value)
+                return
+            if self.spill_file is None:
+                self.spill_file = tempfile.TemporaryFile(dir=self.directory)
+            self.spill_file.seek(0, os.SEEK_END)
+            self.spilled[key] = (self.spill_file.tell(), len(value))
+            self.spill_file.write(value)
+
+    def pop(self, key):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.size -= len(value)
+            self.spilled.pop(key, None)
+
+    def close(self):
+        """ Removes all values and the temporary file """
+        with self.lock:
+            if self.spill_file:
+                self.spill_file.close()
+                self.spill_file = None
+            self.items = {}
+            self.spilled = {}
+            self.size = 0
+
+
+def read_ahead(iterable, count):
+    """ Yields items of iterable, consuming up to count items in advance.
+
+    Useful to start jobs for upcoming items early, if the iterable submits
+    them to a WorkerPool when producing its items. """
+    window = collections.deque()
+    for item in iterable:
+        window.append(item)
+        if len(window) > count:
+            yield window.popleft()
+    while window:
+        yield window.popleft()
+
+
+WALK_READ_AHEAD = 256
+
+
+def list_directory(dirname):
+    """ Returns (name, full name, stat) tuples of a directory, sorted by name.
+
+    Names of directories end with a slash. Returns an empty list if the
+    directory can't be read. """
+    try:
+        names = os.listdir(dirname)
+    except OSError:
+        return []
+    entries = []
+    for name in names:
+        fullname = os.path.join(dirname, name)
+        try:
+            stat = os.lstat(fullname)
+        except OSError:  # removed in the meantime
+            continue
+        if S_ISDIR(stat.st_mode):
+            name += os.path.sep
+        entries.append((name, fullname, stat))
+    entries.sort()
+    return entries
+
+
+def iter_files(path, workers=0):
+    """ Yields all directories and files in path, sorted by their names.
+
+    Returns tuples of the relative name and its lstat result. Names of
+    directories end with a slash and are sorted as such; a directory is
+    followed by its content. Thus the order of all names is the same as if
+    all of them were sorted at once.
+
+    Subdirectories are listed ahead by a pool of workers, which hides the
+    latency of listing and stat calls on network filesystems. """
+    path = os.path.expanduser(path).encode("utf-8")
+    pool = WorkerPool(workers)
+
+    def walk(rel_dirname, job):
+        def entries():
+            for name, fullname, stat in job.result():
+                subdir_job = None
+                if S_ISDIR(stat.st_mode):
+                    subdir_job = pool.submit(list_directory, fullname)
+                yield name, stat, subdir_job
+
+        for name, stat, subdir_job in read_ahead(entries(), WALK_READ_AHEAD):
+            rel_name = rel_dirname + name
+            yield rel_name, stat
+            if subdir_job:
+                for item in walk(rel_name, subdir_job):
+                    yield item
+
+    try:
+        for item in walk('', pool.submit(list_directory, path)):
+            yield item
+    finally:
+        pool.close()
+
+
 def find_modified_files(path):
     """ Find all directories and files in path.
 
     Returns a dictionary composed of filesystem names as keys and their
     stat as values. """
-    path = os.path.expanduser(path).encode("utf-8")
-    filelist = collections.OrderedDict()
-    for dirname, _, filenames in os.walk(path):
-        stat = os.lstat(dirname)
+    return collections.OrderedDict(
+        (name, stat2dict(stat)) for name, stat in iter_files(path))
 
-        rel_dirname = dirname.replace(path, '')
-        rel_dirname += os.path.sep
-        rel_dirname = rel_dirname.lstrip('/')
 
-        if rel_dirname:  # skip root entry
-            filelist[rel_dirname] = stat2dict(stat)
+def merge_join(items, other):
+    """ Yields (key, value, other value) tuples for all items.
 
-        for filename in filenames:
-            fullname = os.path.join(dirname, filename)
-            stat = os.lstat(fullname)
-            rel_filename = os.path.join(rel_dirname, filename)
-            filelist[rel_filename] = stat2dict(stat)
-    return filelist
+    Both items and other are iterables of (key, value) tuples sorted by
+    key. The other value is taken from the item of other with the same key,
+    or is None if there is none. """
+    other = iter(other)
+    other_key, other_value = next(other, (None, None))
+    for key, value in items:
+        while other_key is not None and other_key < key:
+            other_key, other_value = next(other, (None, None))
+        yield key, value, other_value if other_key == key else None
+
+
+class FileCache(object):
+    """ Persistent cache of stored files, keyed by device and inode number.
+
+    Stores ctime, mtime, size and the object name of every file of a backup,
+    and the name of the tree of every directory, keyed by its path. Only
+    files and directories seen during the current backup are kept when
+    saving.
+
+    Cached names are only valid for the generation of the repository they
+    were saved with, see common.generation(); entries of other generations
+    are dropped when loading. """
+    def __init__(self, filename, generation=()):
+        self.filename = filename
+        self.generation = generation
+        self.entries = {}
+        self.new_entries = {}
+        self.trees = {}
+        self.new_trees = {}
+        try:
+            with open(filename, "rb") as infile:
+                data = marshal.load(infile)
+            if isinstance(data, tuple) and len(data) == 3 and \
+                    data[0] == generation:  # older caches are dropped
+                _, self.entries, self.trees = data
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+
+    def get(self, stat):
+        """ Returns the object name of an unchanged file or None """
+        entry = self.entries.get((stat.st_dev, stat.st_ino))
+        if entry and entry[:3] == (stat.st_ctime, stat.st_mtime,
+                                   stat.st_size):
+            return entry[3]
+
+    def previous(self, stat):
+        """ Returns the object name stored for an inode, even if changed """
+        entry = self.entries.get((stat.st_dev, stat.st_ino))
+        return entry[3] if entry else None
+
+    def add(self, stat, name):
+        self.new_entries[(stat.st_dev, stat.st_ino)] = (
+            stat.st_ctime, stat.st_mtime, stat.st_size, name)
+
+    def tree(self, path):
+        """ Returns the name of the tree stored for a directory or None """
+        return self.trees.get(path)
+
+    def add_tree(self, path, name):
+        self.new_trees[path] = name
+
+    def save(self):
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmpname = self.filename + ".tmp"
+        with open(tmpname, "wb") as outfile:
+            marshal.dump((self.generation, self.new_entries, self.new_trees),
+                         outfile)
+        os.rename(tmpname, self.filename)
+        self.entries = self.new_entries
+        self.trees = self.new_trees
+
+
+def files_cache_name(storage, src):
+    """ Returns the default FileCache filename for a storage and a source or
+    a list of sources """
+    if isinstance(src, basestring):
+        src = [src]
+    key = "\0".join(
+        [os.path.abspath(os.path.expanduser(storage))] +
+        sorted(os.path.abspath(os.path.expanduser(path)) for path in src))
+    return os.path.join(os.path.expanduser("~/.cache/safebox"),
+                        "files-%s" % sha256_string(key)[:16])
 
 
 def stat2dict(stat):
@@ -79,4 +353,135 @@ def sizeof_fmt(num):
     return "%3.1f %s" % (num, unit)
 
 
-newest_backup_id = lambda list_of_backups: os.path.basename(list_of_backups[-1])
+class Job(object):
+    """ Placeholder for the result of a function run by a WorkerPool """
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    @classmethod
+    def finished(cls, result):
+        """ Returns a Job which is already done with the given result """
+        job = cls()
+        job._result = result
+        job._done.set()
+        return job
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self):
+        """ Wait for the job and return its result or re-raise its error """
+        self._done.wait()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def run(self, func, args, kwargs):
+        try:
+            self._result = func(*args, **kwargs)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        self._done.set()
+
+
+class WorkerPool(object):
+    """ A fixed set of threads executing jobs from a bounded queue.
+
+    submit() blocks while the queue is full, which throttles a producer that
+    reads faster than the workers are able to process the data. Using less
+    than one worker runs every job immediately in the calling thread. """
+    def __init__(self, workers=1, queue_size=None):
+        self.queue = Queue.Queue(queue_size or max(workers, 1) * 4)
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(
+                target=self._work, name="Worker-%d" % (i + 1))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            job, func, args, kwargs = item
+            job.run(func, args, kwargs)
+
+    def submit(self, func, *args, **kwargs):
+        """ Queue func for execution and return its Job """
+        job = Job()
+        if self.threads:
+            self.queue.put((job, func, args, kwargs))
+        else:
+            job.run(func, args, kwargs)
+        return job
+
+    def close(self):
+        """ Finish all queued jobs and stop the worker threads """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+class ProcessJob(object):
+    """ Placeholder for the result of a function run by a ProcessPool """
+    def __init__(self, async_result):
+        self.async_result = async_result
+
+    def done(self):
+        return self.async_result.ready()
+
+    def result(self):
+        """ Wait for the job and return its result or re-raise its error """
+        return self.async_result.get()
+
+
+class ProcessPool(object):
+    """ A fixed set of processes executing jobs, usable like a WorkerPool.
+
+    Functions, their arguments and their results are pickled, thus functions
+    must be defined at module level. initializer is called with initargs
+    once in every process after it is forked. In contrast to WorkerPool,
+    submit() never blocks; the caller has to limit the pending jobs. """
+    def __init__(self, processes, initializer=None, initargs=()):
+        self.pool = multiprocessing.Pool(processes, initializer, initargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, func, *args, **kwargs):
+        """ Queue func for execution and return its ProcessJob """
+        return ProcessJob(self.pool.apply_async(func, args, kwargs))
+
+    def close(self):
+        """ Finish all queued jobs and stop the processes """
+        self.pool.close()
+        self.pool.join()
+
+
+def newest_backup_id(list_of_backups):
+    """ Returns the name of the newest backup, or None if there is none.
+
+    Backup names end with a timestamp and a random suffix of 8 characters,
+    see common.backup(). """
+    newest = None
+    for backup in list_of_backups:
+        name = os.path.basename(backup)
+        if newest is None or \
+                (name[-28:-9], name) > (newest[-28:-9], newest):
+            newest = name
+    return newest
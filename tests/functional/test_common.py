@@ -22,7 +22,7 @@ import unittest
 from filecmp import dircmp
 
 import mock
-from safebox import backends, common, utils
+from safebox import backends, common, stats, utils
 
 
 class TestBackupRestore(unittest.TestCase):
@@ -63,7 +63,7 @@ class TestBackupRestore(unittest.TestCase):
 
         # Create new backup, this should reuse the last metadata set and the
         # checksum should be reused. Metadata set should be identical
-        with mock.patch('logging.info') as mock_log:
+        with mock.patch('logging.debug') as mock_log:
             backup_id = common.backup(self.backend, self.backup_dir)
             mock_log.assert_any_call('Skipped unchanged sub/o\xcc\x88')
         new_file = os.path.join(self.storage_dir, backup_id)
@@ -87,6 +87,409 @@ class TestBackupRestore(unittest.TestCase):
             new_hash = utils.sha256_file(new_filename)
             self.assertEqual(old_hash, new_hash)
 
+    def test_stats(self):
+        """ Test if phases of backup and restore are instrumented """
+        stats.reset()
+        backup_id = common.backup(self.backend, self.backup_dir)
+        snapshot = stats.snapshot()
+        self.assertEqual(4, snapshot['counters']['files'])
+        self.assertEqual(self.original_size, snapshot['counters']['bytes'])
+        self.assertTrue(snapshot['counters']['new_chunks'] > 0)
+        for timer in ["scan", "chunk", "hash", "compress", "backend_write"]:
+            self.assertTrue(timer in snapshot['timers'], timer)
+
+        stats.reset()
+        common.restore(self.backend, self.restore_dir, backup_id)
+        snapshot = stats.snapshot()
+        self.assertEqual(self.original_size,
+                         snapshot['counters']['total_bytes'])
+        self.assertEqual(self.original_size, snapshot['counters']['bytes'])
+        for timer in ["plan", "backend_read", "decompress", "write"]:
+            self.assertTrue(timer in snapshot['timers'], timer)
+
+    def test_backup_workers(self):
+        """ Test if metadata is independent of the number of workers """
+        manifests = []
+        for workers in [0, 1, 8]:
+            backup_id = common.backup(
+                self.backend, self.backup_dir, workers=workers)
+            manifests.append(self.backend.get(backup_id))
+            shutil.rmtree(self.storage_dir)
+            os.mkdir(self.storage_dir)
+        self.assertEqual(manifests[0], manifests[1])
+        self.assertEqual(manifests[0], manifests[2])
+
+    def test_chunked_file(self):
+        """ Test if only jobs of chunks in progress are kept """
+        chunked = common.ChunkedFile()
+        pending = utils.Job()
+        chunked.add(utils.Job.finished(("a", 1, True)))
+        chunked.add(pending)
+        chunked.add(utils.Job.finished(("c", 3, False)))
+        self.assertEqual([("a", 1, True)], chunked.records)
+        self.assertFalse(chunked.done())
+        pending.run(lambda: ("b", 2, True), (), {})
+        self.assertTrue(chunked.done())
+        self.assertEqual(0, len(chunked.jobs))
+        checksum, records, _ = chunked.result()
+        self.assertEqual(["a", "b", "c"], [r[0] for r in records])
+
+    def test_backup_processes(self):
+        """ Test if metadata is the same if files are chunked by processes """
+        manifests = []
+        for processes in [0, 2]:
+            backend = backends.LocalStorage(
+                os.path.join(self.storage_dir, str(processes)))
+            stats.reset()
+            backup_id = common.backup(
+                backend, self.backup_dir, processes=processes)
+            manifests.append(backend.get(backup_id))
+            self.assertTrue(stats.snapshot()['timers']['chunk'] > 0)
+            backup_id = common.backup(
+                backend, self.backup_dir, processes=processes)
+            restore_dir = os.path.join(self.restore_dir, str(processes))
+            common.restore(backend, restore_dir, backup_id)
+            result = dircmp(restore_dir, self.backup_dir)
+            self.assertFalse(result.diff_files)
+            self.assertFalse(result.left_only + result.right_only)
+        self.assertEqual(manifests[0], manifests[1])
+
+        backend = backends.PackedStorage(self.storage_dir)
+        self.assertRaises(ValueError, common.backup, backend,
+                          self.backup_dir, processes=2)
+
+    def test_invalid_name(self):
+        """ Test if names that are not valid UTF-8 are skipped """
+        latin1_file = os.path.join(self.backup_dir, 'caf\xe9')
+        with open(latin1_file, "wb") as outfile:
+            outfile.write("latin-1")
+        with mock.patch('logging.warning') as mock_log:
+            backup_id = common.backup(self.backend, self.backup_dir)
+            mock_log.assert_called_once_with(
+                "%s is not a valid UTF-8 name, skipping" % latin1_file)
+        os.remove(latin1_file)
+
+        # The repository is still readable by restore, gc and backup
+        common.restore(self.backend, self.restore_dir, backup_id)
+        result = dircmp(self.restore_dir, self.backup_dir)
+        self.assertFalse(result.diff_files)
+        self.assertFalse(result.left_only + result.right_only)
+        common.gc(self.backend)
+        common.backup(self.backend, self.backup_dir)
+
+    def test_backup_sources(self):
+        """ Test if multiple sources are stored as top-level directories """
+        other_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(other_dir, 'y'), "wb") as outfile:
+                outfile.write("other")
+            sources = [self.subdir, other_dir, self.tempfile]
+            backup_id = common.backup(self.backend, sources)
+            with mock.patch('logging.debug') as mock_log:
+                backup_id = common.backup(self.backend, sources)
+                mock_log.assert_any_call('Skipped unchanged sub/o\xcc\x88')
+
+            other_name = os.path.basename(other_dir)
+            common.restore(self.backend, self.restore_dir, backup_id)
+            self.assertEqual(sorted(['sub', other_name, 'x']),
+                             sorted(os.listdir(self.restore_dir)))
+            self.assertEqual(
+                utils.sha256_file(self.tempfile),
+                utils.sha256_file(os.path.join(self.restore_dir, 'x')))
+            result = dircmp(os.path.join(self.restore_dir, 'sub'),
+                            self.subdir)
+            self.assertFalse(result.diff_files)
+            self.assertFalse(result.left_only + result.right_only)
+            with open(os.path.join(self.restore_dir, other_name, 'y')) as f:
+                self.assertEqual("other", f.read())
+
+            os.mkdir(os.path.join(other_dir, "sub"))
+            self.assertRaises(ValueError, common.backup, self.backend,
+                              [self.subdir, os.path.join(other_dir, "sub")])
+
+            # Missing sources are detected before anything is stored
+            shutil.rmtree(self.storage_dir)
+            os.mkdir(self.storage_dir)
+            backend = backends.LocalStorage(self.storage_dir)
+            self.assertRaises(ValueError, common.backup, backend,
+                              [self.subdir, os.path.join(other_dir, "none")])
+            self.assertEqual([], os.listdir(self.storage_dir))
+        finally:
+            shutil.rmtree(other_dir)
+
+    def test_restore_workers(self):
+        """ Test if restoring works with any number of workers """
+        backup_id = common.backup(self.backend, self.backup_dir)
+        for workers in [0, 1, 8]:
+            restore_dir = os.path.join(self.restore_dir, str(workers))
+            common.restore(self.backend, restore_dir, backup_id,
+                           workers=workers)
+            result = dircmp(restore_dir, self.backup_dir)
+            self.assertFalse(result.diff_files)
+            self.assertFalse(result.left_only + result.right_only)
+            for _, entry in result.subdirs.items():
+                self.assertFalse(entry.diff_files)
+            self.assertAlmostEqual(
+                os.stat(self.subdir).st_mtime,
+                os.stat(os.path.join(restore_dir, 'sub')).st_mtime, places=3)
+
+    def test_restore_cache(self):
+        """ Test if chunks used multiple times are fetched only once """
+        backup_id = common.backup(self.backend, self.backup_dir)
+        stats = common.restore(self.backend, self.restore_dir, backup_id)
+        self.assertTrue(stats['fetched'] < stats['chunks'])
+
+    def test_restore_filter(self):
+        """ Test if only selected entries and their chunks are restored """
+        backup_id = common.backup(self.backend, self.backup_dir)
+        with mock.patch.object(self.backend, 'get',
+                               wraps=self.backend.get) as mock_get:
+            stats = common.restore(self.backend, self.restore_dir, backup_id,
+                                   include=["sub"])
+            fetched = [args[0] for args, _ in mock_get.call_args_list]
+        self.assertEqual(['sub'], os.listdir(self.restore_dir))
+        self.assertEqual(
+            utils.sha256_file(self.subfile),
+            utils.sha256_file(os.path.join(self.restore_dir, 'sub/o\xcc\x88')))
+        self.assertEqual(2, stats['files'])
+        chunks = [name for name in fetched if name.startswith('c-')]
+        self.assertEqual(len(chunks), stats['fetched'])
+        self.assertEqual(sorted(set(chunks)), sorted(chunks))
+
+        shutil.rmtree(self.restore_dir)
+        common.restore(self.backend, self.restore_dir, backup_id,
+                       exclude=["sub/*", "z"])
+        self.assertEqual(['sub', 'x'], sorted(os.listdir(self.restore_dir)))
+        self.assertEqual([], os.listdir(os.path.join(self.restore_dir, 'sub')))
+
+    def test_restore_spill(self):
+        """ Test if every chunk is fetched once even without memory """
+        backup_id = common.backup(self.backend, self.backup_dir)
+        stats = common.restore(self.backend, self.restore_dir, backup_id,
+                               cache_size=0)
+        self.assertTrue(stats['fetched'] < stats['chunks'])
+        chunks = set(os.path.basename(obj)
+                     for obj in self.backend.list("c-*"))
+        self.assertEqual(len(chunks), stats['fetched'])
+        result = dircmp(self.restore_dir, self.backup_dir)
+        self.assertFalse(result.diff_files)
+
+    def test_restore_incremental(self):
+        """ Test if existing data in dst is reused """
+        backup_id = common.backup(self.backend, self.backup_dir)
+        common.restore(self.backend, self.restore_dir, backup_id)
+        restored = os.path.join(self.restore_dir, 'x')
+        with open(restored, "r+b") as outfile:
+            outfile.seek(205000)
+            outfile.write("changed")
+
+        with mock.patch.object(self.backend, 'get',
+                               wraps=self.backend.get) as mock_get:
+            stats = common.restore(self.backend, self.restore_dir, backup_id,
+                                   incremental=True)
+            fetched = [args[0] for args, _ in mock_get.call_args_list
+                       if args[0].startswith('c-')]
+        self.assertEqual(2, stats['skipped'])
+        self.assertTrue(stats['reused'] > 0)
+        self.assertEqual(len(fetched), stats['fetched'])
+        self.assertTrue(0 < len(fetched) < stats['reused'])
+        self.assertEqual(utils.sha256_file(self.tempfile),
+                         utils.sha256_file(restored))
+        result = dircmp(self.restore_dir, self.backup_dir)
+        self.assertFalse(result.diff_files)
+        self.assertFalse(result.left_only + result.right_only)
+
+        # Unchanged files are not written at all
+        stats = common.restore(self.backend, self.restore_dir, backup_id,
+                               incremental=True)
+        self.assertEqual(3, stats['skipped'])
+        self.assertEqual(0, stats['fetched'] + stats['reused'])
+
+    def test_restore_incremental_tmp(self):
+        """ Test if temporary files never replace restored files """
+        tmpname = os.path.join(self.backup_dir, 'x.safebox-tmp')
+        shutil.copy(self.tempfile, tmpname)
+        backup_id = common.backup(self.backend, self.backup_dir)
+        common.restore(self.backend, self.restore_dir, backup_id)
+        for fn in ['x', 'x.safebox-tmp']:
+            with open(os.path.join(self.restore_dir, fn), "r+b") as outfile:
+                outfile.write("changed")
+
+        common.restore(self.backend, self.restore_dir, backup_id,
+                       incremental=True)
+        result = dircmp(self.restore_dir, self.backup_dir)
+        self.assertFalse(result.diff_files)
+        self.assertFalse(result.left_only + result.right_only)
+        self.assertEqual(utils.sha256_file(tmpname), utils.sha256_file(
+            os.path.join(self.restore_dir, 'x.safebox-tmp')))
+
+    def test_files_cache(self):
+        """ Test if unchanged files are detected using the files cache """
+        files_cache = os.path.join(self.restore_dir, 'cache')
+        common.backup(self.backend, self.backup_dir, files_cache=files_cache)
+        self.assertTrue(os.path.exists(files_cache))
+
+        with open(self.tempfile, "r+b") as outfile:
+            outfile.write("changed")
+        with mock.patch('safebox.common.load_manifest') as mock_load:
+            with mock.patch('logging.debug') as mock_log:
+                with mock.patch.object(self.backend, 'get',
+                                       wraps=self.backend.get) as mock_get:
+                    with mock.patch.object(self.backend, 'exists_many') as \
+                            mock_exists:
+                        backup_id = common.backup(self.backend,
+                                                  self.backup_dir,
+                                                  files_cache=files_cache)
+                        self.assertFalse(mock_exists.called)
+                    names = [args[0] for args, _ in mock_get.call_args_list]
+                mock_log.assert_any_call('Skipped unchanged sub/o\xcc\x88')
+                mock_log.assert_any_call(self.tempfile)
+            self.assertFalse(mock_load.called)
+            self.assertEqual([], [n for n in names if n.startswith("b-")])
+
+        # Without the cache the latest backup is loaded
+        with mock.patch('safebox.common.load_manifest',
+                        wraps=common.load_manifest) as mock_load:
+            common.backup(self.backend, self.backup_dir)
+            self.assertTrue(mock_load.called)
+
+        common.restore(self.backend, self.restore_dir, backup_id)
+        for fn in ['x', 'sub/o\xcc\x88']:
+            self.assertEqual(
+                utils.sha256_file(os.path.join(self.backup_dir, fn)),
+                utils.sha256_file(os.path.join(self.restore_dir, fn)))
+
+    @mock.patch('safebox.common.HINT_MIN_SIZE', 0)
+    def test_hinted_chunks(self):
+        """ Test if chunks of the previous version are used as hints """
+        common.backup(self.backend, self.backup_dir)
+
+        # Files with unchanged content are not chunked again
+        os.utime(self.tempfile, (0, 0))
+        with mock.patch('safebox.common.rabin') as mock_rabin:
+            common.backup(self.backend, self.backup_dir)
+            self.assertFalse(mock_rabin.called)
+
+        # Only changed chunks are stored, without any rolling checksums or
+        # lookups of the previous chunks
+        with open(self.tempfile, "r+b") as outfile:
+            outfile.seek(300000)
+            outfile.write("changed")
+        self.assertEqual((1, False), self._hinted_backup())
+
+        # Chunks after inserted data match the previous chunks again
+        with open(self.tempfile, "rb") as infile:
+            data = infile.read()
+        with open(self.tempfile, "wb") as outfile:
+            outfile.write(data[:300000] + "inserted" + data[300000:])
+        new_chunks, chunked = self._hinted_backup()
+        self.assertTrue(new_chunks <= 2)
+        self.assertFalse(chunked)
+
+        # Changes shifting the data differently are found again by splitting
+        # only the data following them into content-defined chunks
+        with open(self.tempfile, "wb") as outfile:
+            outfile.write(data[:100000] + data[100100:])
+        self.assertTrue(self._hinted_backup()[0] <= 4)
+        with open(self.tempfile, "r+b") as outfile:
+            outfile.seek(50000)
+            outfile.write(os.urandom(100000))
+        self._hinted_backup()
+
+        # Appended data is chunked as well
+        with open(self.tempfile, "ab") as outfile:
+            outfile.write(os.urandom(100000))
+        self._hinted_backup()
+
+    def _hinted_backup(self):
+        """ Backs up changed data, returns the number of new chunks and
+        whether any data was split into content-defined chunks """
+        stats.reset()
+        with mock.patch('safebox.common.rabin',
+                        side_effect=common.rabin) as mock_rabin:
+            with mock.patch.object(self.backend, 'exists_many') as mock_exists:
+                backup_id = common.backup(self.backend, self.backup_dir)
+                self.assertFalse(mock_exists.called)
+            filenames = [args[0] for args, _ in mock_rabin.call_args_list]
+            self.assertFalse(self.tempfile in filenames)
+        shutil.rmtree(self.restore_dir)
+        common.restore(self.backend, self.restore_dir, backup_id)
+        self.assertEqual(
+            utils.sha256_file(self.tempfile),
+            utils.sha256_file(os.path.join(self.restore_dir, 'x')))
+        return (stats.snapshot()['counters'].get('new_chunks', 0),
+                mock_rabin.called)
+
+    def test_sparse(self):
+        """ Test if zero-filled extents are restored as holes """
+        sparse = os.path.join(self.backup_dir, 'sparse')
+        with open(sparse, "wb") as outfile:
+            outfile.write(os.urandom(100000))
+            outfile.seek(4000000, os.SEEK_CUR)
+            outfile.write(os.urandom(100000))
+            outfile.truncate(8000000)
+        zeros = os.path.join(self.backup_dir, 'zeros')
+        with open(zeros, "wb") as outfile:
+            outfile.write("\0" * 1000)
+
+        backup_id = common.backup(self.backend, self.backup_dir)
+        stored = sum(self.backend.size(os.path.basename(name))
+                     for name in self.backend.list("c-*"))
+        self.assertTrue(stored < 1000000)
+
+        common.restore(self.backend, self.restore_dir, backup_id)
+        for fn in ['sparse', 'zeros']:
+            self.assertEqual(
+                utils.sha256_file(os.path.join(self.backup_dir, fn)),
+                utils.sha256_file(os.path.join(self.restore_dir, fn)))
+        stat = os.stat(os.path.join(self.restore_dir, 'sparse'))
+        self.assertEqual(8000000, stat.st_size)
+        self.assertTrue(stat.st_blocks * 512 < 1000000)
+
+    def test_packed_storage(self):
+        """ Test if backup, restore and gc work with pack files """
+        self.backend = backends.PackedStorage(self.storage_dir)
+        self.test_gc()
+        self.assertTrue(os.listdir(os.path.join(self.storage_dir, "p")))
+        self.assertFalse(os.path.exists(os.path.join(self.storage_dir, "c")))
+
+    def test_trees(self):
+        """ Test if trees of unchanged directories are reused """
+        old_id = common.backup(self.backend, self.backup_dir)
+        with open(self.tempfile, "r+b") as outfile:
+            outfile.write("changed")
+        new_id = common.backup(self.backend, self.backup_dir)
+        old = common.load_manifest(self.backend, old_id)
+        new = common.load_manifest(self.backend, new_id)
+        self.assertNotEqual(old.name, new.name)
+        self.assertEqual(old.get("sub/"), new.get("sub/"))
+        self.assertEqual(3, len(list(self.backend.list("t-*"))))
+
+        # Trees of unchanged directories are neither compressed nor stored;
+        # both backups may have been created within the same second
+        self.backend.delete(old_id)
+        with mock.patch.object(self.backend, 'put',
+                               wraps=self.backend.put) as mock_put:
+            common.backup(self.backend, self.backup_dir)
+            names = [args[0][0] for args in mock_put.call_args_list]
+            self.assertEqual([], [n for n in names if n.startswith("t-")])
+
+        # Trees named in the files cache are not stored again either
+        files_cache = os.path.join(self.restore_dir, 'cache')
+        common.backup(self.backend, self.backup_dir, files_cache=files_cache)
+        for changed in [False, True]:
+            if changed:
+                with open(self.tempfile, "r+b") as outfile:
+                    outfile.write("again")
+            with mock.patch.object(self.backend, 'put',
+                                   wraps=self.backend.put) as mock_put:
+                backup_id = common.backup(self.backend, self.backup_dir,
+                                          files_cache=files_cache)
+                names = [args[0][0] for args in mock_put.call_args_list
+                         if args[0][0].startswith("t-")]
+            root = common.load_manifest(self.backend, backup_id).name
+            self.assertEqual([root] if changed else [], names)
+
     def test_gc(self):
         """ Test if deletion of no longer required chunks works correctly
 
@@ -101,9 +504,35 @@ class TestBackupRestore(unittest.TestCase):
         backup_path, backup_file = self.backend.fullname(backup_id)
         os.remove(backup_file)
         os.remove(os.path.join(self.backup_dir, "x"))
-        backup_id = common.backup(self.backend, self.backup_dir)
+        files_cache = os.path.join(self.restore_dir, 'cache')
+        backup_id = common.backup(self.backend, self.backup_dir,
+                                  files_cache=files_cache)
+        unused = common.gc(self.backend, dry_run=True)
+        self.assertTrue(unused)
+        self.assertEqual((), common.generation(self.backend))
         removed = common.gc(self.backend)
-        self.assertTrue(removed)
+        self.assertEqual(sorted(unused), sorted(removed))
+        generation = common.generation(self.backend)
+        self.assertEqual(1, len(generation))
+        self.assertFalse(common.gc(self.backend))
+        self.assertNotEqual(generation, common.generation(self.backend))
+        self.assertEqual(1, len(common.generation(self.backend)))
+
+        # Objects deleted out of band are dropped from the index
+        name = "t-" + "f" * 64
+        self.backend.put(name, "")
+        os.remove(self.backend.fullname(name)[1])
+        self.assertTrue(self.backend.exists(name))
+        common.gc(self.backend)
+        self.assertFalse(self.backend.exists(name))
+
+        # Files caches saved before are not trusted anymore
+        with mock.patch('safebox.common.load_manifest',
+                        wraps=common.load_manifest) as mock_load:
+            common.backup(self.backend, self.backup_dir,
+                          files_cache=files_cache)
+            self.assertTrue(mock_load.called)
+        shutil.rmtree(self.restore_dir)
 
         common.restore(self.backend, self.restore_dir, backup_id)
 
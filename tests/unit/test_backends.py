@@ -15,12 +15,18 @@ See the License for the specific language governing permissions and
 limitations under the License.
 
 """
+import BaseHTTPServer
+import bz2
 import os
 import shutil
+import SocketServer
 import tempfile
+import threading
 import unittest
+import urlparse
 
-from safebox import backends
+import mock
+from safebox import backends, compression, utils
 
 
 class TestLocalStorage(unittest.TestCase):
@@ -41,6 +47,158 @@ class TestLocalStorage(unittest.TestCase):
         # Non-existing object
         self.assertRaises(Exception, self.backend.get, "nonexisting")
 
+    def test_put_failed(self):
+        """ Test if objects are created completely or not at all """
+        pathname, filename = self.backend.fullname("c-1")
+        with mock.patch('os.link', side_effect=OSError(28, "No space")):
+            self.assertRaises(OSError, self.backend.put, "c-1", "content")
+        self.assertFalse(os.path.exists(filename))
+        self.assertEqual([], os.listdir(os.path.join(self.tempdir, "tmp")))
+        self.assertFalse("c-1" in self.backend.index)
+
+        self.assertTrue(self.backend.put("c-1", "content"))
+        self.assertEqual(0644, os.stat(filename).st_mode & 0777)
+        self.assertEqual([], os.listdir(os.path.join(self.tempdir, "tmp")))
+        self.assertEqual(["c-1"], [os.path.basename(name)
+                                   for name in self.backend.list()])
+
+    def test_codec(self):
+        """ Test if objects are compressed with the given codec """
+        backend = backends.LocalStorage(self.tempdir, codec="zlib:1")
+        backend.put("c-1", "content" * 100)
+        pathname, filename = backend.fullname("c-1")
+        with open(filename, "rb") as infile:
+            self.assertTrue(infile.read().startswith("SBX1"))
+        self.assertEqual("content" * 100, self.backend.get("c-1"))
+
+        # Objects written by older versions are bz2 compressed
+        pathname, filename = backend.fullname("c-2")
+        os.makedirs(pathname)
+        with open(filename, "wb") as outfile:
+            outfile.write(bz2.compress("content"))
+        self.assertEqual("content", backend.get("c-2"))
+
+    def test_index(self):
+        """ Test if known objects are not written again """
+        name = "c-" + "a" * 64
+        self.assertTrue(self.backend.put(name, "content"))
+        with mock.patch('os.path.exists') as mock_exists:
+            self.assertFalse(self.backend.put(name, "content"))
+            self.assertFalse(mock_exists.called)
+
+        # Index is persistent once flushed and updated when deleting objects
+        self.backend.flush()
+        backend = backends.LocalStorage(self.tempdir)
+        self.assertTrue(name in backend.index)
+        backend.delete(name)
+        self.assertFalse(name in backend.index)
+        self.assertTrue(backend.put(name, "content"))
+
+        # Existing objects are added to a missing index
+        os.remove(backend.index.filename)
+        backend = backends.LocalStorage(self.tempdir)
+        self.assertFalse(backend.put(name, "content"))
+        backend.close()
+        self.assertTrue(name in backends.LocalStorage(self.tempdir).index)
+
+    def test_index_batches(self):
+        """ Test if added names are logged in batches """
+        index = backends.ChunkIndex(os.path.join(self.tempdir, "index"))
+        index.batch_size = 10
+        with mock.patch('os.open', side_effect=os.open) as mock_open:
+            for i in range(25):
+                index.add("c-%064x" % i)
+            self.assertEqual(2, mock_open.call_count)
+        self.assertEqual(5, len(index.pending))
+
+        # Pending names are logged before removed ones
+        index.discard_many(["c-%064x" % 24])
+        with open(index.filename) as infile:
+            lines = infile.read().splitlines()
+        self.assertEqual(26, len(lines))
+        self.assertEqual("-c-%064x" % 24, lines[-1])
+        self.assertFalse("c-%064x" % 24 in backends.ChunkIndex(index.filename))
+
+    def test_index_compact(self):
+        """ Test if obsolete index entries are removed when loading """
+        index = backends.ChunkIndex(os.path.join(self.tempdir, "index"))
+        for i in range(1000):
+            index.add("c-%064x" % i)
+        index.discard_many(["c-%064x" % i for i in range(900)])
+        index = backends.ChunkIndex(index.filename)
+        self.assertTrue("c-%064x" % 999 in index)
+        self.assertFalse("c-%064x" % 1 in index)
+        with open(index.filename) as infile:
+            self.assertEqual(100, len(infile.readlines()))
+        self.assertEqual(["index"], os.listdir(self.tempdir))
+        self.assertEqual(0644, os.stat(index.filename).st_mode & 0777)
+
+    def test_rebuild_index(self):
+        """ Test if a stale index is rebuilt from the objects on disk """
+        for name in ["c-1", "c-2", "t-1", "b-1"]:
+            self.backend.put(name, "content")
+        self.backend.flush()
+        os.remove(self.backend.fullname("c-1")[1])
+        os.remove(self.backend.fullname("b-1")[1])
+        other = backends.LocalStorage(self.tempdir)
+        other.put("c-3", "content")
+        self.assertTrue(self.backend.exists("c-1"))
+        self.assertFalse("c-3" in self.backend.index)
+
+        self.assertEqual(3, self.backend.rebuild_index())
+        self.assertFalse(self.backend.exists("c-1"))
+        self.assertTrue(self.backend.put("c-1", "content"))
+        self.backend.flush()
+        index = backends.LocalStorage(self.tempdir).index
+        for name in ["c-1", "c-2", "c-3", "t-1"]:
+            self.assertTrue(name in index)
+        self.assertEqual(0644, os.stat(index.filename).st_mode & 0777)
+
+    def test_delete_many(self):
+        """ Test if sizes are reported and batches are deleted """
+        self.backend.put("c-1", "content")
+        self.backend.put("c-2", "content")
+        self.assertTrue(self.backend.size("c-1") > 0)
+        self.assertEqual([("c-1", self.backend.size("c-1")),
+                          ("c-2", self.backend.size("c-2"))],
+                         list(self.backend.size_many(["c-1", "c-2"])))
+        self.backend.delete_many(["c-1", "c-2"])
+        self.assertRaises(Exception, self.backend.get, "c-1")
+        self.assertRaises(Exception, self.backend.get, "c-2")
+
+    def test_batches(self):
+        """ Test if batch operations work with and without a pool """
+        items = [("c-%d" % i, "content %d" % i) for i in range(10)]
+        self.assertEqual(["c-0", "c-1"], self.backend.put_many(items[:2]))
+        with utils.WorkerPool(4) as pool:
+            self.assertEqual(["c-%d" % i for i in range(2, 10)],
+                             self.backend.put_many(items, pool))
+            self.assertEqual(items, list(self.backend.get_many(
+                ["c-%d" % i for i in range(10)], pool)))
+            self.assertEqual(set(["c-1", "c-9"]), self.backend.exists_many(
+                ["c-1", "c-9", "c-10"], pool))
+            self.backend.delete_many(["c-1", "c-9"], pool)
+        self.assertEqual(set(), self.backend.exists_many(["c-1", "c-9"]))
+
+        with mock.patch.object(self.backend.codec, 'compress') as compress:
+            self.assertEqual([], self.backend.put_many(items[:1]))
+            self.assertFalse(compress.called)
+
+    def test_list(self):
+        """ Test if objects are listed by type and pattern """
+        for name in ["b-1", "b-2", "c-1234", "c-5678", "o-1234"]:
+            self.backend.put(name, "content")
+
+        names = lambda prefix: sorted(
+            os.path.basename(obj) for obj in self.backend.list(prefix))
+        self.assertEqual(["b-1", "b-2"], names("b-*"))
+        self.assertEqual(["c-1234", "c-5678"], names("c-*"))
+        self.assertEqual(["c-5678"], names("c-5*"))
+        self.assertEqual(["o-1234"], names("o-*"))
+        self.assertEqual([], names("t-*"))
+        self.assertEqual(["b-1", "b-2", "c-1234", "c-5678", "o-1234"],
+                         names(""))
+
     def test_fullname(self):
         """ Test if self.backend.fullname is working correctly """
         objname = "c-af2bdbe1aa9b6ec1e2ade1d694f41f"
@@ -54,5 +212,293 @@ class TestLocalStorage(unittest.TestCase):
         self.assertEqual(reference, fullname)
 
 
+class TestPackedStorage(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.backend = backends.PackedStorage(self.tempdir, pack_size=2000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def packs(self):
+        return [name for name in os.listdir(self.backend.pack_path)
+                if name.endswith(".pack")]
+
+    def test_put_get(self):
+        """ Test if chunks are stored in pack files """
+        names = ["c-%064x" % i for i in range(20)]
+        for name in names:
+            self.assertTrue(self.backend.put(name, os.urandom(100)))
+            self.assertFalse(self.backend.put(name, "content"))
+        self.backend.put("o-1", "content")
+
+        self.assertEqual(2, len(self.packs()))
+        self.assertEqual(["c-%064x" % i for i in range(20)],
+                         sorted(self.backend.list("c-*")))
+        self.assertEqual(["o-1"], [os.path.basename(name) for name in
+                                   self.backend.list("o-*")])
+
+        for pack in self.packs():
+            mode = os.stat(os.path.join(self.backend.pack_path, pack)).st_mode
+            self.assertEqual(0644, mode & 0777)
+
+        # Packed chunks are found by other instances too
+        backend = backends.PackedStorage(self.tempdir)
+        data = self.backend.get(names[3])
+        self.assertEqual(data, backend.get(names[3]))
+        self.assertEqual(100, len(data))
+        self.assertTrue(backend.exists(names[3]))
+        self.assertEqual("content", backend.get("o-1"))
+
+    def test_put_failed(self):
+        """ Test if a pack is not appended to after a failed write """
+        self.assertTrue(self.backend.put("c-1", "content"))
+        with mock.patch('os.write', side_effect=OSError(28, "No space")):
+            self.assertRaises(OSError, self.backend.put, "c-2", "content")
+        self.assertFalse(self.backend.exists("c-2"))
+        self.assertTrue(self.backend.put("c-2", "other content"))
+        self.assertEqual(2, len(self.packs()))
+        self.backend.flush()
+        backend = backends.PackedStorage(self.tempdir)
+        self.assertEqual("content", backend.get("c-1"))
+        self.assertEqual("other content", backend.get("c-2"))
+
+    def test_index_batches(self):
+        """ Test if index lines are logged per pack """
+        backend = backends.PackedStorage(self.tempdir)
+        self.assertFalse(backend.exists("c-1"))  # loads the index
+        with mock.patch('__builtin__.open', side_effect=open) as mock_open:
+            for i in range(10):
+                backend.put("c-%064x" % i, "content")
+            self.assertFalse(mock_open.called)
+        self.assertFalse(os.path.exists(backend.pack_index))
+        backend.flush()
+        self.assertEqual(
+            10, len(list(backends.PackedStorage(self.tempdir).list())))
+
+        # Lines of a full pack are logged when it is closed
+        for i in range(10, 30):
+            self.backend.put("c-%064x" % i, os.urandom(100))
+        with open(self.backend.pack_index) as infile:
+            logged = len(infile.readlines())
+        self.assertTrue(10 < logged < 30)
+        self.backend.delete_many(["c-%064x" % 29])
+        with open(self.backend.pack_index) as infile:
+            self.assertEqual(31, len(infile.readlines()))
+
+    def test_loose_chunks(self):
+        """ Test if chunks stored by LocalStorage are still used """
+        backends.LocalStorage(self.tempdir).put("c-1234", "content")
+        self.assertFalse(self.backend.put("c-1234", "content"))
+        self.assertEqual("content", self.backend.get("c-1234"))
+        self.backend.delete("c-1234")
+        self.assertFalse(self.backend.exists("c-1234"))
+
+    def test_repack(self):
+        """ Test if packs with mostly unused chunks are rewritten """
+        names = ["c-%064x" % i for i in range(20)]
+        for name in names:
+            self.backend.put(name, os.urandom(100))
+        self.backend.delete_many(names[:15])
+        self.assertFalse(self.backend.exists(names[0]))
+
+        backend = backends.PackedStorage(self.tempdir, pack_size=2000)
+        self.assertEqual(names[15:], sorted(backend.list("c-*")))
+        self.assertTrue(backend.repack() > 1000)
+        self.assertEqual(1, len(self.packs()))
+        for name in names[15:]:
+            self.assertEqual(100, len(backend.get(name)))
+        self.assertEqual(0, backend.repack())
+
+    def test_rebuild(self):
+        """ Test if a lost index is rebuilt from the packs """
+        names = ["c-%064x" % i for i in range(20)]
+        data = dict((name, os.urandom(100)) for name in names)
+        for name in names:
+            self.backend.put(name, data[name])
+        self.backend.delete_many(names[:15])
+        self.backend.repack()
+        os.remove(self.backend.pack_index)
+
+        # A chunk cut off while appending it is ignored
+        pack = os.path.join(self.backend.pack_path, self.packs()[0])
+        with open(pack, "ab") as outfile:
+            outfile.write(backends.PACK_RECORD.pack(66, 100) + names[0])
+
+        backend = backends.PackedStorage(self.tempdir, pack_size=2000)
+        self.assertEqual([], list(backend.list("c-*")))
+        # Deleted chunks in packs that were not rewritten are listed again
+        self.assertEqual(8, backend.rebuild())
+        for name in names[15:]:
+            self.assertEqual(data[name], backend.get(name))
+        backend = backends.PackedStorage(self.tempdir, pack_size=2000)
+        self.assertEqual(names[12:], sorted(backend.list("c-*")))
+
+
+class FakeSwiftHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Minimal stand-in for a Swift container, keeping objects in memory """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=""):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _object(self):
+        parsed = urlparse.urlparse(self.path)
+        return parsed, parsed.path.split("/", 5)[-1]
+
+    def do_PUT(self):
+        server = self.server
+        server.requests.append(self.command)
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        parsed, name = self._object()
+        if parsed.path.count("/") == 3:
+            server.container = True
+            return self._reply(201)
+        if server.failures:
+            server.failures -= 1
+            return self._reply(503)
+        if not server.container:
+            return self._reply(404)
+        if name in server.objects and self.headers.get("If-None-Match"):
+            return self._reply(412)
+        server.objects[name] = data
+        self._reply(201)
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.command)
+        parsed, name = self._object()
+        if parsed.path.count("/") == 3:
+            query = dict(urlparse.parse_qsl(parsed.query))
+            names = sorted(n for n in server.objects
+                           if n.startswith(query.get("prefix", "")) and
+                           n > query.get("marker", ""))
+            names = names[:int(query.get("limit", 10000))]
+            return self._reply(200, "".join(n + "\n" for n in names))
+        if name not in server.objects:
+            return self._reply(404)
+        self._reply(200, server.objects[name])
+
+    def do_HEAD(self):
+        parsed, name = self._object()
+        if name not in self.server.objects:
+            return self._reply(404)
+        self._reply(200, self.server.objects[name])
+
+    def do_DELETE(self):
+        parsed, name = self._object()
+        if self.server.objects.pop(name, None) is None:
+            return self._reply(404)
+        self._reply(204)
+
+
+class FakeSwiftServer(SocketServer.ThreadingMixIn,
+                      BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ("127.0.0.1", 0), FakeSwiftHandler)
+        self.objects = {}
+        self.requests = []
+        self.container = False
+        self.failures = 0
+
+
+class TestSwiftStorage(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSwiftServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        url = "http://127.0.0.1:%d/v1/AUTH_test/backups" % (
+            self.server.server_address[1])
+        self.backend = backends.SwiftStorage(url, backoff=0)
+
+    def tearDown(self):
+        self.backend.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_put_get(self):
+        """ Test if objects are stored in the container """
+        self.assertTrue(self.backend.put("c-1", "content"))
+        self.assertTrue(self.server.container)
+        self.assertEqual(
+            compression.decompress(self.server.objects["c-1"]), "content")
+        self.assertEqual(self.backend.get("c-1"), "content")
+        self.assertTrue(self.backend.exists("c-1"))
+        self.assertFalse(self.backend.exists("c-2"))
+        self.assertRaises(IOError, self.backend.get, "c-2")
+
+        # Known objects are not uploaded again
+        self.server.requests = []
+        self.assertFalse(self.backend.put("c-1", "content"))
+        self.assertEqual(self.server.requests, [])
+
+        # Objects stored by other clients are detected by the server
+        self.server.objects["c-3"] = "x"
+        self.assertFalse(self.backend.put("c-3", "content"))
+        self.assertEqual(self.server.objects["c-3"], "x")
+
+    def test_retry(self):
+        """ Test if failing requests are retried """
+        self.server.container = True
+        self.server.failures = 2
+        self.assertTrue(self.backend.put("c-1", "content"))
+        self.assertEqual(self.server.requests, ["PUT", "PUT", "PUT"])
+
+        self.backend.retries = 1
+        self.server.failures = 2
+        self.assertRaises(IOError, self.backend.put, "c-2", "content")
+
+    def test_list(self):
+        """ Test if listings are paginated and filtered """
+        self.assertEqual(list(self.backend.list()), [])
+        for i in range(25):
+            self.backend.put("c-%02d" % i, "")
+        self.backend.put("b-default-1", "")
+        self.backend.list_limit = 10
+
+        self.server.requests = []
+        names = list(self.backend.list("c-*"))
+        self.assertEqual(names, ["c-%02d" % i for i in range(25)])
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(list(self.backend.list("b-*")), ["b-default-1"])
+        self.assertEqual(len(list(self.backend.list())), 26)
+
+    def test_get_many(self):
+        """ Test if batches of objects are fetched concurrently """
+        names = ["c-%02d" % i for i in range(20)]
+        self.backend.put_many((name, name) for name in names)
+        self.assertEqual(len(self.server.objects), 20)
+        self.assertEqual([(name, name) for name in names],
+                         list(self.backend.get_many(names)))
+        self.assertEqual(set(names[:5]), self.backend.exists_many(
+            names[:5] + ["c-20"]))
+
+    def test_delete_many(self):
+        """ Test if objects are deleted concurrently """
+        for i in range(20):
+            self.backend.put("c-%02d" % i, "data")
+        self.assertEqual(self.backend.size("c-00"),
+                         len(self.server.objects["c-00"]))
+        sizes = list(self.backend.size_many(["c-00", "c-01"]))
+        self.assertEqual([(name, len(self.server.objects[name]))
+                          for name in ["c-00", "c-01"]], sizes)
+        self.backend.delete_many(["c-%02d" % i for i in range(15)])
+        self.assertEqual(len(self.server.objects), 5)
+        self.assertFalse(self.backend.exists("c-00"))
+        self.assertRaises(IOError, self.backend.delete, "c-00")
+
+
 if __name__ == '__main__':
     unittest.main()
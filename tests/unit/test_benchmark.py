@@ -0,0 +1,104 @@
+#!/usr/bin/python
+"""
+Copyright 2014 Christian Schwede.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+import copy
+import json
+import random
+import shutil
+import tempfile
+import unittest
+
+from safebox import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_random_data(self):
+        """ Test if generated data is reproducible """
+        data = benchmark.random_data(random.Random(1), 1000)
+        self.assertEqual(1000, len(data))
+        self.assertEqual(data, benchmark.random_data(random.Random(1), 1000))
+        self.assertEqual("", benchmark.random_data(random.Random(1), 0))
+
+    def test_run(self):
+        """ Test if all operations of all scenarios are measured """
+        results = benchmark.run(scale=0.005, workers=2,
+                                workdir=self.tempdir)
+        self.assertEqual(sorted(benchmark.SCENARIOS),
+                         sorted(results['scenarios']))
+        for name, scenario in results['scenarios'].items():
+            self.assertTrue(scenario['source_bytes'] > 0)
+            self.assertTrue(scenario['dedup_ratio'] > 0)
+            self.assertEqual(
+                ["backup", "backup_incremental", "gc", "list", "restore",
+                 "restore_incremental"], sorted(scenario['operations']))
+            for metrics in scenario['operations'].values():
+                self.assertTrue(metrics['seconds'] >= 0)
+                self.assertTrue(metrics['max_rss_kb'] > 0)
+        backup = results['scenarios']['large_files']['operations']['backup']
+        self.assertEqual(4, backup['counters']['files'])
+        self.assertTrue('chunk' in backup['timers'])
+        duplicates = results['scenarios']['duplicate_files']
+        self.assertTrue(duplicates['dedup_ratio'] > 1)
+        self.assertEqual(results, json.loads(json.dumps(results)))
+
+    def test_measure(self):
+        """ Test if the peak memory usage of an operation is measured """
+        result, metrics = benchmark.measure(len, "x" * 2 ** 20)
+        self.assertEqual(2 ** 20, result)
+        _, large = benchmark.measure(lambda: len("x" * 64 * 2 ** 20))
+        self.assertTrue(large['max_rss_kb'] > metrics['max_rss_kb'] + 32768)
+        self.assertRaises(ZeroDivisionError, benchmark.measure,
+                          lambda: 1 / 0)
+
+    def test_compare(self):
+        """ Test if increased metrics are reported as regressions """
+        old = {'scenarios': {'small_files': {
+            'dedup_ratio': 2.0, 'operations': {
+                'backup': {'seconds': 1.0, 'read_write_calls': 1000},
+                'restore': {'seconds': 2.0}}}}}
+        new = copy.deepcopy(old)
+        self.assertEqual([], benchmark.compare(old, new))
+        new['scenarios']['small_files']['operations']['backup'].update(
+            {'seconds': 1.05, 'read_write_calls': 1200})
+        new['scenarios']['large_files'] = old['scenarios']['small_files']
+        self.assertEqual(
+            [('small_files', 'backup', 'read_write_calls', 1000, 1200)],
+            benchmark.compare(old, new))
+        self.assertEqual(2, len(benchmark.compare(old, new, threshold=0.01)))
+
+        # Less deduplication and more memory are regressions as well
+        new = copy.deepcopy(old)
+        new['scenarios']['small_files']['dedup_ratio'] = 1.5
+        new['scenarios']['small_files']['operations']['restore'].update(
+            {'max_rss_kb': 20000})
+        old['scenarios']['small_files']['operations']['restore'].update(
+            {'max_rss_kb': 10000})
+        self.assertEqual(
+            [('small_files', 'scenario', 'dedup_ratio', 2.0, 1.5),
+             ('small_files', 'restore', 'max_rss_kb', 10000, 20000)],
+            benchmark.compare(old, new))
+        self.assertEqual([], benchmark.compare(new, old))
+
+
+if __name__ == '__main__':
+    unittest.main()
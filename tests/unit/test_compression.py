@@ -0,0 +1,55 @@
+#!/usr/bin/python
+"""
+Copyright 2014 Christian Schwede.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+import bz2
+import os
+import unittest
+
+from safebox import compression
+
+
+class TestCompression(unittest.TestCase):
+    def test_codecs(self):
+        """ Test if data is compressed and decompressed by all codecs """
+        data = "sample" * 1000
+        for spec in ["none", "zlib", "zlib:1", "bz2", "bz2:1"]:
+            compressed = compression.Codec(spec).compress(data)
+            self.assertTrue(compressed.startswith(compression.MAGIC))
+            self.assertEqual(data, compression.decompress(compressed))
+            if spec != "none":
+                self.assertTrue(len(compressed) < len(data))
+
+    def test_invalid_codec(self):
+        self.assertRaises(ValueError, compression.Codec, "unknown")
+        self.assertRaises(ValueError, compression.Codec, "zlib:x")
+
+    def test_store_raw(self):
+        """ Test if incompressible data is stored without compression """
+        data = os.urandom(100000)
+        compressed = compression.Codec("zlib").compress(data)
+        self.assertEqual(compression.MAGIC + compression.NONE + data,
+                         compressed)
+        self.assertEqual(data, compression.decompress(compressed))
+
+    def test_legacy(self):
+        """ Test if objects without header are read as bz2 """
+        data = "sample"
+        self.assertEqual(data, compression.decompress(bz2.compress(data)))
+
+
+if __name__ == '__main__':
+    unittest.main()
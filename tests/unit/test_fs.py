@@ -0,0 +1,105 @@
+#!/usr/bin/python
+"""
+Copyright 2014 Christian Schwede.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+import errno
+import shutil
+import tempfile
+import unittest
+
+import mock
+from safebox import backends, fs, manifest
+
+
+def entry(size, mode, content=None):
+    result = {'s': size, 'u': 1000, 'g': 100, 'm': 1400000000.0, 'p': mode}
+    if content:
+        result['c'] = content
+    return result
+
+
+class TestBackupFS(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.backend = backends.LocalStorage(self.tempdir)
+        self.chunks = ["a" * 100, "b" * 50, "c" * 70]
+        for i, data in enumerate(self.chunks):
+            self.backend.put("c-%d" % i, data)
+        self.backend.put("o-1", "0:100;zero:30;1:50;2:70")
+        files = {
+            "dir/": entry(0, 040755),
+            "dir/big": entry(250, 0100644, "o-1"),
+            "dir/sub/": entry(0, 040755),
+            "dir/sub/small": entry(50, 0100600, "c-1"),
+            "empty": entry(0, 0100644),
+        }
+        writer = manifest.TreeWriter(self.backend.put)
+        for path in sorted(files):
+            writer.add(path, files[path])
+        self.backend.put("b-1", writer.getvalue())
+        self.backend.put("b-2", manifest.dumps(files))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_listdir_stat(self):
+        """ Test if directories are listed for trees and flat manifests """
+        for backup_id in ["b-1", "b-2"]:
+            backup_fs = fs.BackupFS(self.backend, backup_id)
+            self.assertEqual(["dir", "empty"], backup_fs.listdir("/"))
+            self.assertEqual(["big", "sub"], backup_fs.listdir("/dir/"))
+            self.assertEqual(["small"], backup_fs.listdir("dir/sub"))
+            self.assertEqual(0100600, backup_fs.stat("/dir/sub/small")['p'])
+            self.assertEqual(040755, backup_fs.stat("/dir/sub")['p'])
+            with self.assertRaises(OSError) as cm:
+                backup_fs.stat("dir/missing")
+            self.assertEqual(errno.ENOENT, cm.exception.errno)
+            self.assertRaises(OSError, backup_fs.listdir, "dir/big")
+            self.assertRaises(IOError, backup_fs.open, "dir")
+
+    def test_read(self):
+        """ Test if ranges are read from the chunks containing them """
+        backup_fs = fs.BackupFS(self.backend, "b-1")
+        content = self.chunks[0] + "\0" * 30 + self.chunks[1] + self.chunks[2]
+        self.assertEqual(content, backup_fs.open("dir/big").read())
+        self.assertEqual("", backup_fs.open("empty").read())
+        self.assertEqual(self.chunks[1],
+                         backup_fs.open("dir/sub/small").read())
+
+        backup_fs = fs.BackupFS(self.backend, "b-1")
+        with mock.patch.object(self.backend, 'get',
+                               wraps=self.backend.get) as mock_get:
+            for offset, length in [(90, 50), (0, 300), (245, 10), (300, 1)]:
+                self.assertEqual(content[offset:offset + length],
+                                 backup_fs.read("dir/big", offset, length))
+            fetched = [args[0] for args, _ in mock_get.call_args_list]
+        self.assertEqual(["o-1", "c-0", "c-1", "c-2"], fetched)
+
+    def test_file(self):
+        """ Test if files can be read sequentially """
+        backup_fs = fs.BackupFS(self.backend, "b-2")
+        with backup_fs.open("dir/big") as infile:
+            self.assertEqual("a" * 10, infile.read(10))
+            infile.seek(95)
+            self.assertEqual("a" * 5 + "\0" * 5, infile.read(10))
+            self.assertEqual(105, infile.tell())
+            infile.seek(-5, 2)
+            self.assertEqual("c" * 5, infile.read())
+            self.assertEqual("", infile.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+"""
+Copyright 2014 Christian Schwede.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+import json
+import unittest
+
+from safebox import manifest
+
+
+def entry(i, content=None):
+    result = {'s': i, 'u': 1000, 'g': 100, 'm': 1400000000.123456,
+              'p': 0100644}
+    if content:
+        result['c'] = content
+    return result
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.files = {}
+        for i in range(10000):
+            self.files["dir%d/" % (i % 10)] = entry(0)
+            self.files["dir%d/file%d" % (i % 10, i)] = entry(i, "c-%064x" % i)
+        self.files['o\xcc\x88'] = entry(1, "o-%064x" % 1)
+
+    def test_roundtrip(self):
+        """ Test if all entries are returned sorted by path """
+        data = manifest.dumps(self.files)
+        self.assertTrue(data.startswith("SBM1"))
+        meta_data = manifest.Manifest(data)
+        self.assertTrue(len(meta_data.block_paths) > 1)
+
+        items = list(meta_data.items())
+        reference = sorted((path.decode('utf-8'), entry)
+                           for path, entry in self.files.items())
+        self.assertEqual(reference, items)
+        self.assertTrue(isinstance(items[0][0], unicode))
+
+    def test_get(self):
+        """ Test if single entries are found """
+        meta_data = manifest.Manifest(manifest.dumps(self.files))
+        for path in ["dir0/", "dir3/file1233", "dir9/file9999", "o\xcc\x88"]:
+            self.assertEqual(self.files[path], meta_data.get(path))
+        self.assertEqual(self.files["o\xcc\x88"],
+                         meta_data.get(u"o\u0308"))
+        self.assertEqual(None, meta_data.get("dir3/file1234"))
+        self.assertEqual(None, meta_data.get("a"))
+        self.assertEqual(None, meta_data.get("z"))
+
+    def test_descend(self):
+        """ Test if entries of skipped directories are not returned """
+        meta_data = manifest.Manifest(manifest.dumps(self.files))
+        paths = list(path for path, _ in meta_data.items(
+            lambda path, entry: path == "dir3/"))
+        self.assertEqual(1011, len(paths))
+        self.assertTrue(u"dir3/file1233" in paths)
+        self.assertEqual(u"o\u0308", paths[-1])
+
+    def test_empty(self):
+        meta_data = manifest.Manifest(manifest.dumps({}))
+        self.assertEqual([], list(meta_data.items()))
+        self.assertEqual(None, meta_data.get("a"))
+
+    def test_sorted(self):
+        """ Test if entries must be added in sorted order """
+        writer = manifest.Writer()
+        writer.add("b", entry(1))
+        self.assertRaises(ValueError, writer.add, "a", entry(1))
+        self.assertRaises(ValueError, writer.add, "b", entry(1))
+
+    def test_invalid_path(self):
+        """ Test if paths that can't be read as UTF-8 are rejected """
+        writer = manifest.Writer()
+        self.assertRaises(ValueError, writer.add, "caf\xe9", entry(1))
+        writer.add(u"caf\xe9", entry(1))
+        self.assertEqual([u"caf\xe9"],
+                         list(manifest.Manifest(writer.getvalue())))
+
+    def test_json(self):
+        """ Test if JSON manifests written by earlier versions are read """
+        meta_data = manifest.Manifest(json.dumps(self.files))
+        self.assertEqual(self.files["dir3/file1233"],
+                         meta_data.get("dir3/file1233"))
+        self.assertEqual(self.files["o\xcc\x88"], meta_data.get("o\xcc\x88"))
+        paths = list(meta_data)
+        self.assertEqual(sorted(paths), paths)
+        self.assertEqual(len(self.files), len(paths))
+
+
+class TestTree(unittest.TestCase):
+    def setUp(self):
+        self.files = {}
+        for i in range(100):
+            self.files["dir%d/" % (i % 10)] = entry(0)
+            self.files["dir%d/sub/" % (i % 10)] = entry(0)
+            self.files["dir%d/sub/file%d" % (i % 10, i)] = entry(i, "c-%d" % i)
+            self.files["dir%d.txt" % i] = entry(i)
+        self.files['o\xcc\x88'] = entry(1, "o-%064x" % 1)
+        self.objects = {}
+
+    def dumps(self, files):
+        writer = manifest.TreeWriter(self.objects.__setitem__)
+        for path in sorted(files):
+            writer.add(path, files[path])
+        return writer.getvalue()
+
+    def test_roundtrip(self):
+        """ Test if entries are stored in one tree per directory """
+        data = self.dumps(self.files)
+        self.assertTrue(data.startswith("SBT1t-"))
+        self.assertEqual(21, len(self.objects))
+        meta_data = manifest.load(data, self.objects.get)
+        self.assertTrue(isinstance(meta_data, manifest.Tree))
+
+        items = list(meta_data.items())
+        reference = sorted((path.decode('utf-8'), entry)
+                           for path, entry in self.files.items())
+        self.assertEqual([path for path, _ in reference],
+                         [path for path, _ in items])
+        self.assertEqual(dict(items)[u"dir3/sub/file93"],
+                         self.files["dir3/sub/file93"])
+        self.assertTrue(dict(items)[u"dir3/"]['c'].startswith("t-"))
+
+    def test_get(self):
+        """ Test if single entries are found by walking the trees """
+        meta_data = manifest.load(self.dumps(self.files), self.objects.get)
+        for path in ["dir3/sub/file93", "dir5.txt", "o\xcc\x88"]:
+            self.assertEqual(self.files[path], meta_data.get(path))
+        self.assertEqual(0, meta_data.get("dir3/sub/")['s'])
+        self.assertEqual(None, meta_data.get("dir3/sub/file94"))
+        self.assertEqual(None, meta_data.get("dir5.txt/file"))
+        self.assertEqual(None, meta_data.get("dir10/sub/"))
+
+    def test_descend(self):
+        """ Test if trees of skipped directories are not fetched """
+        data = self.dumps(self.files)
+        fetched = []
+
+        def fetch(name):
+            fetched.append(name)
+            return self.objects[name]
+
+        meta_data = manifest.load(data, fetch)
+        paths = list(path for path, _ in meta_data.items(
+            lambda path, entry: path.startswith("dir3/")))
+        self.assertEqual(3, len(fetched))
+        self.assertEqual(122, len(paths))
+        self.assertTrue(u"dir3/sub/file93" in paths)
+
+    def test_unchanged_trees(self):
+        """ Test if only trees of changed directories are new """
+        data = self.dumps(self.files)
+        names = set(self.objects)
+        self.files["dir3/sub/file93"] = entry(1, "c-changed")
+        self.assertNotEqual(data, self.dumps(self.files))
+        self.assertEqual(3, len(set(self.objects) - names))
+
+    def test_previous_trees(self):
+        """ Test if trees of the previous backup are not stored again """
+        data = self.dumps(self.files)
+        previous = manifest.load(data, self.objects.get)
+        self.files["dir3/sub/file93"] = entry(1, "c-changed")
+        stored = {}
+        trees = {}
+        writer = manifest.TreeWriter(stored.__setitem__, previous.name,
+                                     trees.__setitem__)
+        for path in sorted(self.files):
+            old = previous.get(path)
+            writer.add(path, self.files[path], old and old.get('c'))
+        self.assertNotEqual(data, writer.getvalue())
+        self.assertEqual(3, len(stored))
+
+        # All trees are reported, including unchanged ones
+        self.assertEqual(21, len(trees))
+        self.assertEqual(previous.get("dir1/")['c'], trees["dir1/"])
+        self.assertTrue(trees[""] in stored)
+
+    def test_fetch_many(self):
+        """ Test if trees of subdirectories are fetched in batches """
+        data = self.dumps(self.files)
+        batches = []
+
+        def fetch_many(names):
+            batches.append(names)
+            return ((name, self.objects[name]) for name in names)
+
+        meta_data = manifest.load(data, self.objects.get, fetch_many)
+        self.assertEqual(len(self.files), len(list(meta_data.items())))
+        self.assertEqual(10, len(batches[0]))
+
+    def test_empty(self):
+        meta_data = manifest.load(self.dumps({}), self.objects.get)
+        self.assertEqual([], list(meta_data.items()))
+        self.assertEqual(None, meta_data.get("a"))
+
+    def test_flat(self):
+        """ Test if flat manifests are still loaded """
+        meta_data = manifest.load(manifest.dumps(self.files), None)
+        self.assertTrue(isinstance(meta_data, manifest.Manifest))
+
+
+if __name__ == '__main__':
+    unittest.main()
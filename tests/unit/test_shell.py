@@ -16,12 +16,16 @@ limitations under the License.
 
 """
 
+import json
 import mock
+import os
+import shutil
 import sys
+import tempfile
 import unittest
 from cStringIO import StringIO
 
-from safebox import shell
+from safebox import shell, stats
 
 
 class TestShell(unittest.TestCase):
@@ -58,6 +62,59 @@ class TestShell(unittest.TestCase):
         self.assertEqual("something", mock_backup.call_args[0][2])
         self.assertEqual("dst", mock_backend.call_args[0][0])
 
+        argv = ["", "backup", "src", "dst", "--workers", "8"]
+        shell.main(argv)
+        self.assertEqual(8, mock_backup.call_args[1]['workers'])
+        self.assertEqual("bz2", mock_backend.call_args[1]['codec'])
+
+        argv = ["", "backup", "src", "dst", "--codec", "zlib:1"]
+        shell.main(argv)
+        self.assertEqual("zlib:1", mock_backend.call_args[1]['codec'])
+
+        argv = ["", "backup", "src", "dst"]
+        shell.main(argv)
+        self.assertTrue(mock_backup.call_args[1]['files_cache'])
+        argv = ["", "backup", "src", "dst", "--files-cache", "cache"]
+        shell.main(argv)
+        self.assertEqual("cache", mock_backup.call_args[1]['files_cache'])
+        argv = ["", "backup", "src", "dst", "--no-files-cache"]
+        shell.main(argv)
+        self.assertEqual(None, mock_backup.call_args[1]['files_cache'])
+
+        argv = ["", "backup", "src", "dst"]
+        shell.main(argv)
+        self.assertEqual(0, mock_backup.call_args[1]['processes'])
+        argv = ["", "backup", "src", "dst", "--processes", "4"]
+        shell.main(argv)
+        self.assertEqual(4, mock_backup.call_args[1]['processes'])
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            for name in ["src", "other", "a/src", "etc", "home"]:
+                os.makedirs(os.path.join(tempdir, name))
+            src, other, etc, home = [os.path.join(tempdir, name) for name in
+                                     ["src", "other", "etc", "home"]]
+            argv = ["", "backup", src, other, "dst"]
+            shell.main(argv)
+            self.assertEqual([src, other], mock_backup.call_args[0][1])
+            self.assertEqual("dst", mock_backend.call_args[0][0])
+            argv = ["", "backup", src, os.path.join(tempdir, "a/src"), "dst"]
+            self.assertRaises(SystemExit, shell.main, argv)
+            argv = ["", "backup", src, os.path.join(tempdir, "none"), "dst"]
+            self.assertRaises(SystemExit, shell.main, argv)
+
+            files_from = os.path.join(tempdir, "sources")
+            with open(files_from, "w") as outfile:
+                outfile.write("%s\n\n%s\n" % (etc, home))
+            argv = ["", "backup", "--files-from", files_from, "dst"]
+            shell.main(argv)
+            self.assertEqual([etc, home], mock_backup.call_args[0][1])
+            argv = ["", "backup", src, "dst", "--files-from", files_from]
+            shell.main(argv)
+            self.assertEqual([src, etc, home], mock_backup.call_args[0][1])
+        finally:
+            shutil.rmtree(tempdir)
+
     @mock.patch('safebox.common.restore')
     @mock.patch('safebox.backends.LocalStorage')
     def test_restore(self, mock_backend, mock_restore):
@@ -80,6 +137,123 @@ class TestShell(unittest.TestCase):
         self.assertEqual("backup_id", mock_restore.call_args[0][2])
         self.assertEqual("src", mock_backend.call_args[0][0])
 
+        argv = ["", "restore", "src", "dst", "backup_id", "--workers", "8"]
+        shell.main(argv)
+        self.assertEqual(8, mock_restore.call_args[1]['workers'])
+
+        argv = ["", "restore", "src", "dst", "backup_id", "--cache-size", "1"]
+        shell.main(argv)
+        self.assertEqual(2 ** 20, mock_restore.call_args[1]['cache_size'])
+
+        argv = ["", "restore", "src", "dst", "backup_id", "--include", "a/*",
+                "--include", "b", "--exclude", "*.tmp"]
+        shell.main(argv)
+        self.assertEqual(["a/*", "b"], mock_restore.call_args[1]['include'])
+        self.assertEqual(["*.tmp"], mock_restore.call_args[1]['exclude'])
+        self.assertFalse(mock_restore.call_args[1]['incremental'])
+
+        argv = ["", "restore", "src", "dst", "backup_id", "--incremental"]
+        shell.main(argv)
+        self.assertTrue(mock_restore.call_args[1]['incremental'])
+
+    @mock.patch('safebox.common.backup')
+    @mock.patch('safebox.backends.PackedStorage')
+    def test_packs(self, mock_backend, mock_backup):
+        """ Test if pack files are used if requested """
+        argv = ["", "--packs", "backup", "src", "dst"]
+        shell.main(argv)
+        self.assertEqual("dst", mock_backend.call_args[0][0])
+        self.assertEqual(mock_backend.return_value,
+                         mock_backup.call_args[0][0])
+
+    @mock.patch('safebox.common.backup')
+    @mock.patch('safebox.backends.SwiftStorage')
+    def test_swift(self, mock_backend, mock_backup):
+        """ Test if container URLs are stored in Swift """
+        url = "http://127.0.0.1:8080/v1/AUTH_test/backups"
+        argv = ["", "--os-auth-token", "token", "backup", "src", url]
+        shell.main(argv)
+        self.assertEqual(url, mock_backend.call_args[0][0])
+        self.assertEqual("token", mock_backend.call_args[1]['token'])
+        self.assertEqual(mock_backend.return_value,
+                         mock_backup.call_args[0][0])
+
+    @mock.patch('safebox.fs.mount')
+    @mock.patch('safebox.fs.BackupFS')
+    @mock.patch('safebox.backends.LocalStorage')
+    def test_mount(self, mock_backend, mock_fs, mock_mount):
+        """ Test if mount args are parsed correctly """
+        argv = ["", "mount", "src", "backup_id", "mnt"]
+        with mock.patch('safebox.fs.fuse', None):
+            self.assertRaises(SystemExit, shell.main, argv)
+        self.assertFalse(mock_mount.called)
+
+        with mock.patch('safebox.fs.fuse'):
+            shell.main(argv)
+        self.assertEqual("backup_id", mock_fs.call_args[0][1])
+        self.assertEqual((mock_fs.return_value, "mnt"),
+                         mock_mount.call_args[0])
+
+    @mock.patch('safebox.benchmark.run')
+    @mock.patch('safebox.backends.LocalStorage')
+    def test_benchmark(self, mock_backend, mock_run):
+        """ Test if benchmark results are written and compared """
+        results = {'scenarios': {'small_files': {'operations': {
+            'backup': {'seconds': 2.0}}}}}
+        mock_run.return_value = results
+        tempdir = tempfile.mkdtemp()
+        try:
+            output = os.path.join(tempdir, "results.json")
+            argv = ["", "benchmark", "--scenario", "small_files",
+                    "--scale", "0.5", "--output", output]
+            shell.main(argv)
+            self.assertFalse(mock_backend.called)
+            self.assertEqual((["small_files"], 0.5),
+                             mock_run.call_args[0][:2])
+            with open(output) as infile:
+                self.assertEqual(results, json.load(infile))
+
+            argv = ["", "benchmark", "--output", output + ".new",
+                    "--compare", output]
+            shell.main(argv)
+            results['scenarios']['small_files']['operations']['backup'][
+                'seconds'] = 3.0
+            self.assertRaises(SystemExit, shell.main, argv)
+        finally:
+            shutil.rmtree(tempdir)
+
+    @mock.patch('safebox.common.gc')
+    @mock.patch('safebox.backends.LocalStorage')
+    def test_stats_file(self, mock_backend, mock_gc):
+        """ Test if stats of a command are written to a file """
+        mock_gc.side_effect = lambda *args, **kwargs: stats.add("test", 3)
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, "stats.json")
+            shell.main(["", "--stats-file", filename, "gc", "src"])
+            with open(filename) as infile:
+                self.assertEqual(3, json.load(infile)['counters']['test'])
+        finally:
+            shutil.rmtree(tempdir)
+
+    @mock.patch('safebox.common.gc')
+    @mock.patch('safebox.backends.LocalStorage')
+    def test_gc(self, mock_backend, mock_gc):
+        """ Test if gc args are parsed correctly """
+
+        # Not enough args
+        argv = ["", "gc"]
+        self.assertRaises(SystemExit, shell.main, argv)
+
+        argv = ["", "gc", "src"]
+        shell.main(argv)
+        self.assertFalse(mock_gc.call_args[1]['dry_run'])
+        self.assertEqual("src", mock_backend.call_args[0][0])
+
+        argv = ["", "gc", "src", "--dry-run"]
+        shell.main(argv)
+        self.assertTrue(mock_gc.call_args[1]['dry_run'])
+
     @mock.patch('safebox.common.list_backups')
     @mock.patch('safebox.backends.LocalStorage')
     def test_list(self, mock_backend, mock_list):
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+"""
+Copyright 2014 Christian Schwede.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+import mock
+from safebox import stats
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.stats = stats.Stats()
+
+    def test_counters_timers(self):
+        """ Test if counters and timers are summed up """
+        self.stats.add("files")
+        self.stats.add("files", 2)
+        with mock.patch('time.time', side_effect=[10.0, 12.5, 20.0, 21.0]):
+            with self.stats.timer("hash"):
+                pass
+            with self.stats.timer("hash"):
+                pass
+        self.assertEqual(3, self.stats.counters['files'])
+        self.assertEqual(3.5, self.stats.snapshot()['timers']['hash'])
+
+        self.assertEqual([1, 2], list(self.stats.timed_iter("scan", [1, 2])))
+        self.assertTrue('scan' in self.stats.snapshot()['timers'])
+
+        self.stats.reset()
+        self.assertEqual({}, self.stats.snapshot()['counters'])
+
+    def test_save(self):
+        self.stats.add("chunks", 5)
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, "stats.json")
+            self.stats.save(filename)
+            with open(filename) as infile:
+                self.assertEqual({'chunks': 5}, json.load(infile)['counters'])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_progress(self):
+        """ Test if throughput and ETA are shown """
+        snapshot = {'elapsed': 2.0, 'counters': {
+            'files': 3, 'bytes': 4 * 2 ** 20, 'total_bytes': 8 * 2 ** 20}}
+        self.assertEqual("3 files, 4.0 MB, 2.0 MB/s, 50.0%, ETA 2s",
+                         stats.format_progress(snapshot))
+        del snapshot['counters']['total_bytes']
+        self.assertEqual("3 files, 4.0 MB, 2.0 MB/s",
+                         stats.format_progress(snapshot))
+
+        stream = StringIO()
+        self.stats.add("files")
+        with stats.Progress(self.stats, interval=0.01, stream=stream):
+            pass
+        self.assertTrue(stream.getvalue().startswith("\r1 files"))
+        self.assertTrue(stream.getvalue().endswith("\n"))
+
+
+if __name__ == '__main__':
+    unittest.main()
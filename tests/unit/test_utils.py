@@ -33,6 +33,80 @@ class TestUtils(unittest.TestCase):
         checksum = utils.sha256_file(self.tempfile + ' ')
         self.assertEqual(None, checksum)
 
+    def test_iter_chunks(self):
+        """ Test if chunks and their offsets are read correctly """
+        with open(self.tempfile, 'rb') as infile:
+            chunks = list(utils.iter_chunks(infile, [2, 3, 1]))
+        self.assertEqual([(0, 'sa'), (2, 'mpl'), (5, 'e')], chunks)
+
+        empty = os.path.join(self.tempdir, 'empty')
+        open(empty, 'wb').close()
+        with open(empty, 'rb') as infile:
+            chunks = list(utils.iter_chunks(infile, [0]))
+        self.assertEqual([(0, '')], chunks)
+
+        # A file truncated while reading ends with a short chunk
+        with open(self.tempfile, 'rb', 0) as infile:
+            chunks = utils.iter_chunks(infile, [2, 3, 1])
+            self.assertEqual((0, 'sa'), next(chunks))
+            with open(self.tempfile, 'r+b') as outfile:
+                outfile.truncate(3)
+            self.assertEqual([(2, 'm')], list(chunks))
+
+    def test_batches(self):
+        self.assertEqual([], list(utils.batches([], 2)))
+        self.assertEqual([[0, 1], [2, 3], [4]],
+                         list(utils.batches(iter(range(5)), 2)))
+
+    def test_spill_cache(self):
+        """ Test if values exceeding the memory limit are kept on disk """
+        cache = utils.SpillCache(10, directory=self.tempdir)
+        cache.put('a', '12345678')
+        cache.put('b', '1234')
+        self.assertEqual(8, cache.size)
+        self.assertTrue(cache.spill_file)
+        self.assertEqual('12345678', cache.get('a'))
+        self.assertEqual('1234', cache.get('b'))
+        self.assertTrue('b' in cache)
+        cache.pop('a')
+        cache.pop('b')
+        self.assertEqual(None, cache.get('a'))
+        self.assertFalse('b' in cache)
+        self.assertEqual(0, cache.size)
+        cache.close()
+        self.assertEqual(None, cache.spill_file)
+
+    def test_lru_cache(self):
+        """ Test if least recently used values are evicted first """
+        cache = utils.LRUCache(10)
+        cache.put('a', '1234')
+        cache.put('b', '1234')
+        self.assertEqual('1234', cache.get('a'))
+        cache.put('c', '1234')
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual('1234', cache.get('a'))
+        self.assertEqual('1234', cache.get('c'))
+        self.assertEqual(8, cache.size)
+
+        # Too large values are not cached at all
+        cache.put('d', '12345678901')
+        self.assertEqual(None, cache.get('d'))
+        self.assertEqual(8, cache.size)
+
+    def test_read_ahead(self):
+        """ Test if items are consumed in advance and yielded in order """
+        consumed = []
+
+        def items():
+            for i in range(10):
+                consumed.append(i)
+                yield i
+
+        iterator = utils.read_ahead(items(), 3)
+        self.assertEqual(0, next(iterator))
+        self.assertEqual(range(4), consumed)
+        self.assertEqual(range(1, 10), list(iterator))
+
     def test_find_files(self):
         """ Test if all files in directory tree are found """
         files = utils.find_modified_files(self.tempdir)
@@ -40,6 +114,73 @@ class TestUtils(unittest.TestCase):
         self.assertTrue('sub/' in files)
         self.assertTrue('sub/file' in files)
 
+    def test_iter_files(self):
+        """ Test if names are returned in sorted order """
+        for name in ['sub-file', 'sub0', 'a']:
+            open(os.path.join(self.tempdir, name), 'w').close()
+        os.mkdir(os.path.join(self.subdir, 'deeper'))
+        for i in range(50):
+            os.mkdir(os.path.join(self.subdir, 'deeper', str(i)))
+        names = [name for name, _ in utils.iter_files(self.tempdir)]
+        self.assertEqual(
+            ['a', 'sample', 'sub-file', 'sub/', 'sub/deeper/',
+             'sub/deeper/0/', 'sub/deeper/1/'], names[:7])
+        self.assertEqual(['sub/file', 'sub0'], names[-2:])
+        self.assertEqual(sorted(names), names)
+
+        # Listing directories concurrently doesn't change the order
+        for workers in [1, 8]:
+            self.assertEqual(names, [
+                name for name, _ in utils.iter_files(self.tempdir, workers)])
+
+    def test_merge_join(self):
+        items = [('a', 1), ('c', 2), ('d', 3), ('f', 4)]
+        other = iter([('b', 'x'), ('c', 'y'), ('f', 'z'), ('g', 'w')])
+        self.assertEqual(
+            [('a', 1, None), ('c', 2, 'y'), ('d', 3, None), ('f', 4, 'z')],
+            list(utils.merge_join(items, other)))
+        self.assertEqual([('a', 1, None)],
+                         list(utils.merge_join([('a', 1)], [])))
+
+    def test_file_cache(self):
+        """ Test if only unchanged files are found in the cache """
+        filename = os.path.join(self.tempdir, 'cache', 'files')
+        cache = utils.FileCache(filename)
+        stat = os.lstat(self.tempfile)
+        self.assertEqual(None, cache.get(stat))
+        cache.add(stat, 'c-1')
+        cache.add_tree("sub/", 't-1')
+        cache.save()
+
+        cache = utils.FileCache(filename)
+        self.assertEqual('c-1', cache.get(stat))
+        self.assertEqual('t-1', cache.tree("sub/"))
+        self.assertEqual(None, cache.tree(""))
+        self.assertEqual(None, cache.get(os.lstat(self.subfile)))
+        os.chmod(self.tempfile, 0600)  # changes ctime
+        stat = os.lstat(self.tempfile)
+        os.utime(self.tempfile, (stat.st_atime, stat.st_mtime + 1))
+        self.assertEqual(None, cache.get(os.lstat(self.tempfile)))
+
+        # Entries not seen again are dropped when saving
+        cache.save()
+        self.assertEqual({}, utils.FileCache(filename).entries)
+        self.assertEqual({}, utils.FileCache(filename).trees)
+
+    def test_file_cache_generation(self):
+        """ Test if the cache is dropped when the generation changed """
+        filename = os.path.join(self.tempdir, 'files')
+        cache = utils.FileCache(filename, ("g-1", ))
+        stat = os.lstat(self.tempfile)
+        cache.add(stat, 'c-1')
+        cache.add_tree("", 't-1')
+        cache.save()
+        self.assertEqual('c-1', utils.FileCache(filename, ("g-1", )).get(stat))
+        for generation in [(), ("g-2", )]:
+            cache = utils.FileCache(filename, generation)
+            self.assertEqual(None, cache.get(stat))
+            self.assertEqual(None, cache.tree(""))
+
     def test_sizeof_fmt(self):
         self.assertEqual('1.0 B', utils.sizeof_fmt(1))
         self.assertEqual('1.0 kB', utils.sizeof_fmt(10**3))
@@ -48,10 +189,35 @@ class TestUtils(unittest.TestCase):
         self.assertEqual('1.0 TB', utils.sizeof_fmt(10**12))
         self.assertEqual('1000.0 TB', utils.sizeof_fmt(10**15))
 
+    def test_files_cache_name(self):
+        self.assertEqual(utils.files_cache_name("storage", "src"),
+                         utils.files_cache_name("storage", ["src"]))
+        self.assertEqual(utils.files_cache_name("storage", ["a", "b"]),
+                         utils.files_cache_name("storage", ["b", "a"]))
+        self.assertNotEqual(utils.files_cache_name("storage", "a"),
+                            utils.files_cache_name("storage", ["a", "b"]))
+
     def test_newest_backup_id(self):
         self.assertEqual('b-1', utils.newest_backup_id(['b-1', ]))
         self.assertEqual('b-2', utils.newest_backup_id(['b-1', 'b-2']))
         self.assertEqual('b-2', utils.newest_backup_id(['b-1', 'a/b/c/b-2']))
+        self.assertEqual(None, utils.newest_backup_id([]))
+        self.assertEqual(
+            'b-a-2014-01-02-00-00-00-abcdefgh',
+            utils.newest_backup_id(iter([
+                'b-a-2014-01-02-00-00-00-abcdefgh',
+                'b-b-2014-01-01-00-00-00-abcdefgh'])))
+
+    def test_worker_pool(self):
+        """ Test if jobs return their results and errors in order """
+        for workers in [0, 1, 4]:
+            with utils.WorkerPool(workers) as pool:
+                jobs = [pool.submit(pow, i, 2) for i in range(100)]
+                failed = pool.submit(int, 'x')
+            self.assertEqual([i ** 2 for i in range(100)],
+                             [job.result() for job in jobs])
+            self.assertTrue(failed.done())
+            self.assertRaises(ValueError, failed.result)
 
 if __name__ == '__main__':
     unittest.main()